@@ -1,11 +1,36 @@
-from dataclasses import asdict, dataclass
-from typing import Dict, Iterator, List, Literal, Optional, TypedDict
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, replace
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Literal, Optional, Tuple, TypedDict
+from urllib.parse import urlparse
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from pymongo.database import Database
+from requests.adapters import HTTPAdapter
 from requests_cache import CachedSession
 from requests_cache.backends import MongoCache
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+from httpCache import URLS_EXPIRE_AFTER, cacheable, createCache
 import os
 
+# (connect, read) in seconds, used when a request does not pass its own timeout
+HTTP_TIMEOUT = (5, 30)
+# number of cached host pools and connections kept open per host
+HTTP_HOST_POOLS = 20
+HTTP_POOL_SIZE = 16
+HTTP_RETRIES = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                     allowed_methods=frozenset(['GET', 'HEAD']))
+# radar frames are dropped when slow, a retry would only delay the animation
+NO_RETRY_PREFIXES = ['https://tilecache.rainviewer.com/']
+STATS_INTERVAL = 10 * 60
+# chats whose state and locations are kept in memory, entries are read again after CHAT_CACHE_TTL
+CHAT_CACHE_SIZE = 1024
+CHAT_CACHE_TTL = 10 * 60
+
 @dataclass
 class Location:
     lat: float
@@ -46,10 +71,185 @@ class State:
             'addLocations': locListDict
         }
 
-def getRequestsCache():
-    return CachedSession(cache_name='/cache/http_cache.sqlite')
+class ConnectionStats:
+    """Per host counts of requests sent over the network and connections opened for them."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.connections: Dict[str, int] = {}
+        self.lastLog = time.monotonic()
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+            self.connections.clear()
+
+    def count(self, counter: Dict[str, int], host: str):
+        with self.lock:
+            counter[host] = counter.get(host, 0) + 1
+
+    def info(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {host: {
+                'requests': requests,
+                'connections': self.connections.get(host, 0),
+                'reused': requests - self.connections.get(host, 0),
+            } for host, requests in self.requests.items()}
+
+
+connectionStats = ConnectionStats()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        connectionStats.count(connectionStats.connections, str(self.host))
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        connectionStats.count(connectionStats.connections, str(self.host))
+        return super()._new_conn()
+
+
+class PooledAdapter(HTTPAdapter):
+    def __init__(self, retries: Retry = HTTP_RETRIES) -> None:
+        super().__init__(pool_connections=HTTP_HOST_POOLS, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries)
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request: Any, timeout: Any = None, **kwargs: Any):  # type: ignore
+        connectionStats.count(connectionStats.requests, str(urlparse(request.url).hostname))
+        return super().send(request, timeout=timeout if timeout is not None else HTTP_TIMEOUT, **kwargs)
+
+
+class SharedSession(CachedSession):
+    """CachedSession that can be used from several threads at once.
+
+    CachedSession keeps the per-request expiry on the instance and holds a lock
+    for the whole request; here it is kept per thread instead, so concurrent
+    requests are not serialized.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        self._local = threading.local()
+        super().__init__(*args, **kwargs)
+        adapter = PooledAdapter()
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        noRetries = PooledAdapter(Retry(0, read=False))
+        for prefix in NO_RETRY_PREFIXES:
+            self.mount(prefix, noRetries)
+
+    @property
+    def _request_expire_after(self):  # type: ignore
+        return getattr(self._local, 'expireAfter', None)
+
+    @_request_expire_after.setter
+    def _request_expire_after(self, value: Any):
+        self._local.expireAfter = value
+
+    @contextmanager
+    def request_expire_after(self, expire_after: Any = None):
+        self._request_expire_after = expire_after
+        try:
+            yield
+        finally:
+            self._request_expire_after = None
+
+
+sessionLock = threading.Lock()
+sessions: Dict[int, SharedSession] = {}
+
+
+def getRequestsCache() -> SharedSession:
+    # one session per process, forked workers create their own
+    pid = os.getpid()
+    with sessionLock:
+        if pid not in sessions:
+            sessions.clear()
+            connectionStats.reset()
+            sessions[pid] = SharedSession(backend=createCache(), urls_expire_after=URLS_EXPIRE_AFTER, filter_fn=cacheable)
+        return sessions[pid]
+
+
+def logConnectionStats(force: bool = False):
+    now = time.monotonic()
+    if not force and now - connectionStats.lastLog < STATS_INTERVAL:
+        return
+    connectionStats.lastLog = now
+    logging.info(f"http connections ({os.getpid()}): {connectionStats.info()}")
+
+class ChatCache:
+    """Bounded LRU of per chat values, an entry expires CHAT_CACHE_TTL after it was stored."""
+
+    entries: "OrderedDict[str, Tuple[Any, float]]"
+
+    def __init__(self, maxSize: int = CHAT_CACHE_SIZE, ttl: float = CHAT_CACHE_TTL) -> None:
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: str) -> Any:
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry != None and time.monotonic() - entry[1] > self.ttl:
+                del self.entries[chat_id]
+                entry = None
+            if entry == None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, chat_id: str) -> Any:
+        """Like get, without counting towards the stats or the LRU order."""
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry == None or time.monotonic() - entry[1] > self.ttl:
+                return None
+            return entry[0]
+
+    def put(self, chat_id: str, value: Any):
+        with self.lock:
+            self.entries[chat_id] = (value, time.monotonic())
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def update(self, chat_id: str, update: Callable[[Any], Any]):
+        """Applies a write to the cached value, a chat that is not cached is read on its next request."""
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry != None:
+                self.entries[chat_id] = (update(entry[0]), entry[1])
+
+    def info(self) -> Dict[str, Any]:
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+def sameLocation(a: Location, b: Location) -> bool:
+    return a.lat == b.lat and a.lon == b.lon
+
 
 class Backend():
+    """Chat states and locations in mongo.
+
+    The bot is the only writer, so states and location lists are cached in
+    memory and every write goes to mongo and the cache.
+    """
+
     mongoClient = MongoClient('mongo', 27017, connect=False)
     requestsSession = getRequestsCache()
 
@@ -59,15 +259,24 @@ class Backend():
         self.db = self.mongoClient.weatherDB
         self.db.locations.create_index(
             [('chat', 1), ('location.lat', 1), ('location.lon', 1)], unique=True)
+        self.db.locations.create_index([('chat', 1), ('location.default', 1)])
+        self.stateCache = ChatCache()
+        self.locationCache = ChatCache()
+        self.local = threading.local()
+        self.stateLock = threading.Lock()
+        # number of state writes per chat, unlike the cache entries these are never evicted
+        self.stateVersions: Dict[str, int] = {}
+
+    def cacheInfo(self) -> Dict[str, Any]:
+        return {'states': self.stateCache.info(), 'locations': self.locationCache.info()}
 
     def addLocation(self, chat_id: str, location: Location) -> bool:
-        if self.db.locations.count({
-            'chat': chat_id,
-            'location.lat': location.lat,
-            'location.lon': location.lon,
-        }, limit=1) > 0:
-          return False
-        self.db.locations.insert_one({'chat': chat_id, 'location': location.toDict()})
+        try:
+            # the unique index rejects a location the chat already has
+            self.db.locations.insert_one({'chat': chat_id, 'location': location.toDict()})
+        except DuplicateKeyError:
+            return False
+        self.locationCache.update(chat_id, lambda locations: locations + [location])
         return True
 
     def removeLocation(self, chat_id: str, location: Location):
@@ -76,17 +285,28 @@ class Backend():
             'location.lat': location.lat,
             'location.lon': location.lon
         })
+        self.locationCache.update(chat_id, lambda locations: [l for l in locations if not sameLocation(l, location)])
 
-    def getLocations(self, chat_id: str) -> Iterator[Location]:
-        cursor = self.db.locations.find({'chat': chat_id})
+    def getLocations(self, chat_id: str) -> List[Location]:
+        locations = self.locationCache.get(chat_id)
+        if locations == None:
+            locations = [Location.fromDict(elem['location']) for elem in self.db.locations.find({'chat': chat_id})]
+            self.locationCache.put(chat_id, locations)
+        return list(locations)
+
+    def getAllLocations(self) -> Iterator[Location]:
+        cursor = self.db.locations.find({}, {'location': 1})
         for elem in cursor:
             yield Location.fromDict(elem['location'])
 
     def getDefaultLocation(self, chat_id: str) -> Optional[Location]:
-        for location in self.getLocations(chat_id):
-            if location.default:
-                return location
-        return None
+        locations = self.locationCache.get(chat_id)
+        if locations != None:
+            return next(filter(lambda l: l.default, locations), None)
+        result = self.db.locations.find_one({'chat': chat_id, 'location.default': True})
+        if result == None:
+            return None
+        return Location.fromDict(result['location'])
 
     def setDefaultLocation(self, chat_id: str, location: Location):
         self.db.locations.update_many({
@@ -98,6 +318,7 @@ class Backend():
             'location.lat': location.lat,
             'location.lon': location.lon
         }, {'$set': {'location.default': True}})
+        self.locationCache.update(chat_id, lambda locations: [replace(l, default=sameLocation(l, location)) for l in locations])
 
     def renameLocation(self, chat_id: str, location: Location, newName: str):
         self.db.locations.find_one_and_update({
@@ -105,15 +326,76 @@ class Backend():
             'location.lat': location.lat,
             'location.lon': location.lon
         }, {'$set': {'location.name': newName}})
+        self.locationCache.update(chat_id, lambda locations: [replace(l, name=newName) if sameLocation(l, location) else l
+                                                          for l in locations])
 
-    def setState(self, chat_id: str, state: State):
+    def writeState(self, chat_id: str, state: State):
         self.db.states.replace_one({'chat': chat_id}, {
             'chat': chat_id,
             'state': state.toDict()
         }, upsert=True)
 
+    def storeState(self, chat_id: str, state: State):
+        # called with stateLock held, the cache only holds states that are in mongo
+        if self.stateCache.peek(chat_id) != state:
+            self.writeState(chat_id, state)
+            self.stateCache.put(chat_id, state)
+            self.stateVersions[chat_id] = self.stateVersions.get(chat_id, 0) + 1
+
+    def setState(self, chat_id: str, state: State):
+        pending: Optional[Dict[str, Tuple[int, Optional[State]]]] = getattr(self.local, 'pendingStates', None)
+        if pending == None:
+            with self.stateLock:
+                self.storeState(chat_id, state)
+        else:
+            # the version the handler last saw, if another handler stores a newer one the deferred write is dropped
+            version = pending[chat_id][0] if chat_id in pending else self.stateVersions.get(chat_id, 0)
+            pending[chat_id] = (version, state)
+
     def getState(self, chat_id: str) -> State:
+        pending: Optional[Dict[str, Tuple[int, Optional[State]]]] = getattr(self.local, 'pendingStates', None)
+        if pending != None and chat_id in pending:
+            version, state = pending[chat_id]
+            if state != None and self.stateVersions.get(chat_id, 0) == version:
+                return state
+        state = self.stateCache.get(chat_id)
+        if state != None:
+            return state
         result = self.db.states.find_one({'chat': chat_id})
-        if result == None:
-            return State('idle')
-        return State.fromDict(result['state'])
+        state = State('idle') if result == None else State.fromDict(result['state'])
+        self.stateCache.put(chat_id, state)
+        return state
+
+    def flushStates(self):
+        """Writes the deferred states of the current thread, called before anything slow like rendering."""
+        pending: Optional[Dict[str, Tuple[int, Optional[State]]]] = getattr(self.local, 'pendingStates', None)
+        if pending == None:
+            return
+        for chat_id, (version, state) in pending.items():
+            if state == None:
+                continue
+            with self.stateLock:
+                if self.stateVersions.get(chat_id, 0) == version:
+                    self.storeState(chat_id, state)
+                    version = self.stateVersions.get(chat_id, 0)
+                else:
+                    logging.info(f"dropping the deferred state of {chat_id}, another update stored a newer one")
+            pending[chat_id] = (version, None)
+
+    @contextmanager
+    def coalescedStates(self) -> Iterator[None]:
+        """Defers the state writes of the current thread, only the last state of a chat is written.
+
+        Deferred states are only visible to the current thread. They are written at
+        the end or on flushStates, unless another handler stored a newer state."""
+        if getattr(self.local, 'pendingStates', None) != None:
+            yield
+            return
+        self.local.pendingStates = {}
+        try:
+            yield
+        finally:
+            try:
+                self.flushStates()
+            finally:
+                self.local.pendingStates = None
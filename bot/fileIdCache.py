@@ -0,0 +1,82 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from telegram.error import BadRequest
+from telegram.message import Message
+
+
+def fileIdOf(message: Message) -> Optional[str]:
+    # telegram may turn an mp4 into an animation, a video or a document
+    if message.photo:
+        return message.photo[-1].file_id
+    for media in (message.animation, message.video, message.document):
+        if media != None:
+            return media.file_id
+    return None
+
+
+class FileIdCache:
+    """Maps image-host ids to the telegram file_id of the first delivery.
+
+    Sending the file_id lets telegram reuse the file it already has instead of
+    downloading it from the image-host again. Image-host ids are content hashes,
+    so an entry never goes stale; a file_id telegram rejects is dropped.
+    """
+
+    maxSize: int
+    fileIds: "OrderedDict[str, str]"
+
+    def __init__(self, maxSize: int) -> None:
+        self.maxSize = maxSize
+        self.fileIds = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, id: str) -> Optional[str]:
+        with self.lock:
+            fileId = self.fileIds.get(id)
+            if fileId != None:
+                self.fileIds.move_to_end(id)
+            return fileId
+
+    def put(self, id: str, fileId: Optional[str]):
+        if fileId == None:
+            return
+        with self.lock:
+            self.fileIds[id] = fileId
+            self.fileIds.move_to_end(id)
+            while len(self.fileIds) > self.maxSize:
+                self.fileIds.popitem(last=False)
+
+    def remember(self, id: str, message: Message):
+        self.put(id, fileIdOf(message))
+
+    def send(self, id: str, url: str, send: Callable[[str], Message]) -> Message:
+        """Sends by file_id if known, else by url, and remembers the resulting file_id."""
+        fileId = self.get(id)
+        if fileId != None:
+            try:
+                message = send(fileId)
+                with self.lock:
+                    self.hits += 1
+                return message
+            except BadRequest as e:
+                logging.warning(f"file_id of {id} rejected, sending the url: {e}")
+                with self.lock:
+                    self.fileIds.pop(id, None)
+        with self.lock:
+            self.misses += 1
+        message = send(url)
+        self.remember(id, message)
+        return message
+
+    def info(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'size': len(self.fileIds),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
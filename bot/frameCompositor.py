@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_PATH = './FiraSans-Regular.ttf'
+FONT_SIZE = 15
+MARKER_PATH = './marker.png'
+MARKER_SIZE = (23, 34)
+LABEL_PADDING = 10
+# white at 128/255 behind the black time label
+LABEL_ALPHA = 128 / 255
+LABEL_CACHE_SIZE = 64
+
+
+class FrameCompositor:
+    """Composites radar frames (base map, overlay, time label and marker).
+
+    Font and marker are loaded once per process and the blending works on
+    preallocated float buffers, so a frame only allocates the decoded overlay
+    and the small time label. One compositor renders one frame at a time.
+    """
+
+    timings: Dict[str, float]
+    frames: int
+
+    def __init__(self, size: Tuple[int, int]) -> None:
+        width, height = size
+        self.font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
+
+        with Image.open(MARKER_PATH) as marker:
+            markerArray = np.asarray(marker.convert('RGBA').resize(MARKER_SIZE), dtype=np.float32)
+        markerAlpha = markerArray[:, :, 3:4] / 255
+        # premultiplied, blending the marker is one multiply and one add
+        self.markerColor = markerArray[:, :, :3] * markerAlpha
+        self.markerInverse = 1 - markerAlpha
+        markerX = int(width / 2 - MARKER_SIZE[0] / 2)
+        markerY = int(height / 2 - MARKER_SIZE[1])
+        self.markerSlice = np.s_[markerY:markerY + MARKER_SIZE[1], markerX:markerX + MARKER_SIZE[0]]
+
+        self.buffer = np.empty((height, width, 3), dtype=np.float32)
+        self.scratch = np.empty((height, width, 3), dtype=np.float32)
+        self.alpha = np.empty((height, width, 1), dtype=np.float32)
+        self.output = np.empty((height, width, 3), dtype=np.uint8)
+        self.labels: "OrderedDict[str, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self.resetTimings()
+
+    def resetTimings(self):
+        self.timings = {'overlay': 0, 'label': 0, 'marker': 0, 'output': 0}
+        self.frames = 0
+
+    def logTimings(self):
+        if self.frames == 0:
+            return
+        stages = ', '.join(f"{stage} {total / self.frames * 1000:.2f}ms" for stage, total in self.timings.items())
+        logging.info(f"composited {self.frames} frames, per frame: {stages}")
+
+    def prepare(self, mapImage: Image.Image) -> np.ndarray:
+        return np.asarray(mapImage.convert('RGB'), dtype=np.float32)
+
+    def blendOverlay(self, overlay: Image.Image):
+        rgba = overlay.convert('RGBA')
+        # radar overlays are mostly transparent, only blend the part with rain
+        bbox = rgba.getchannel('A').getbbox()
+        if bbox == None:
+            return
+        left, top, right, bottom = bbox
+        pixels = np.asarray(rgba)[top:bottom, left:right]
+        region = np.s_[top:bottom, left:right]
+        alpha = self.alpha[region]
+        scratch = self.scratch[region]
+        np.multiply(pixels[:, :, 3:4], 1 / 255, out=alpha)
+        np.subtract(pixels[:, :, :3], self.buffer[region], out=scratch)
+        np.multiply(scratch, alpha, out=scratch)
+        np.add(self.buffer[region], scratch, out=self.buffer[region])
+
+    def label(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Premultiplied color and inverse alpha of the label, the same times
+        appear in every location's animation."""
+        label = self.labels.get(text)
+        if label != None:
+            self.labels.move_to_end(text)
+            return label
+        _, _, right, bottom = self.font.getbbox(text)
+        mask = Image.new('L', (right + 2 * LABEL_PADDING, bottom + 2 * LABEL_PADDING))
+        ImageDraw.Draw(mask).text((LABEL_PADDING, LABEL_PADDING), text, fill=255, font=self.font)
+        textAlpha = np.asarray(mask, dtype=np.float32)[:, :, None] / 255
+        # black text drawn over the translucent white box
+        alpha = LABEL_ALPHA + (1 - LABEL_ALPHA) * textAlpha
+        label = (255 * (1 - textAlpha) * alpha, 1 - alpha)
+        self.labels[text] = label
+        while len(self.labels) > LABEL_CACHE_SIZE:
+            self.labels.popitem(last=False)
+        return label
+
+    def blendLabel(self, timestamp: datetime):
+        color, inverse = self.label(timestamp.strftime('%Y-%m-%d %H:%M'))
+        region = self.buffer[:color.shape[0], :color.shape[1]]
+        np.multiply(region, inverse, out=region)
+        np.add(region, color, out=region)
+
+    def blendMarker(self):
+        region = self.buffer[self.markerSlice]
+        np.multiply(region, self.markerInverse, out=region)
+        np.add(region, self.markerColor, out=region)
+
+    def composite(self, base: np.ndarray, overlay: Image.Image, timestamp: datetime) -> Image.Image:
+        t1 = time.perf_counter()
+        np.copyto(self.buffer, base)
+        self.blendOverlay(overlay)
+        t2 = time.perf_counter()
+        self.blendLabel(timestamp)
+        t3 = time.perf_counter()
+        self.blendMarker()
+        t4 = time.perf_counter()
+        np.add(self.buffer, 0.5, out=self.scratch)
+        np.copyto(self.output, self.scratch, casting='unsafe')
+        # shares the output buffer, the image is only valid until the next frame
+        image = Image.fromarray(self.output)
+        t5 = time.perf_counter()
+
+        self.timings['overlay'] += t2 - t1
+        self.timings['label'] += t3 - t2
+        self.timings['marker'] += t4 - t3
+        self.timings['output'] += t5 - t4
+        self.frames += 1
+        return image
@@ -0,0 +1,235 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from datetime import timedelta
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterator, List
+from urllib.parse import urlparse
+from pymongo import MongoClient
+import requests
+from requests_cache.backends import BaseCache, DbDict, DbPickleDict, MongoCache
+
+# 'sqlite' (WAL mode, sharded), 'mongo' or 'memory'
+HTTP_CACHE_BACKEND = os.environ.get('HTTP_CACHE_BACKEND', 'sqlite')
+HTTP_CACHE_PATH = os.environ.get('HTTP_CACHE_PATH', '/cache/http_cache')
+HTTP_CACHE_SHARDS = int(os.environ.get('HTTP_CACHE_SHARDS', '4'))
+# entries of the per-process memory tier in front of sqlite or mongo, 0 disables it
+HTTP_CACHE_MEMORY_TIER = int(os.environ.get('HTTP_CACHE_MEMORY_TIER', '256'))
+
+# defaults for requests that do not pass their own expire_after
+URLS_EXPIRE_AFTER = {
+    'api.brightsky.dev': 30 * 60,
+    'api.rainviewer.com': 5 * 60,
+    # radar frame urls contain their timestamp and never change
+    'tilecache.rainviewer.com': timedelta(days=1),
+    'nominatim.openstreetmap.org': timedelta(days=7),
+}
+# uploads and their existence checks always go to the host
+UNCACHED_HOSTS = {'image-host'}
+
+
+def cacheable(request: Any) -> bool:
+    return urlparse(request.url).hostname not in UNCACHED_HOSTS
+
+
+def enableWal(path: str):
+    # WAL is persisted in the database file, readers no longer block the writer
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with sqlite3.connect(path) as con:
+        con.execute('PRAGMA journal_mode=WAL')
+
+
+class ShardedDict(MutableMapping):
+    """Spreads keys over several storages, e.g. one sqlite file each, so writers
+    of different keys do not wait for the same database lock."""
+
+    def __init__(self, shards: List[MutableMapping]) -> None:
+        self.shards = shards
+
+    def shard(self, key: str) -> MutableMapping:
+        return self.shards[zlib.crc32(key.encode()) % len(self.shards)]
+
+    def __getitem__(self, key: str) -> Any:
+        return self.shard(key)[key]
+
+    def __setitem__(self, key: str, value: Any):
+        self.shard(key)[key] = value
+
+    def __delitem__(self, key: str):
+        del self.shard(key)[key]
+
+    def __iter__(self) -> Iterator[str]:
+        for shard in self.shards:
+            yield from shard
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    def vacuum(self):
+        for shard in self.shards:
+            shard.vacuum()  # type: ignore
+
+
+class TieredDict(MutableMapping):
+    """Bounded in-memory LRU in front of a persistent storage (write-through)."""
+
+    def __init__(self, backing: MutableMapping, maxSize: int) -> None:
+        self.backing = backing
+        self.maxSize = maxSize
+        self.memory: "OrderedDict[str, Any]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def remember(self, key: str, value: Any):
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.maxSize:
+                self.memory.popitem(last=False)
+
+    def __getitem__(self, key: str) -> Any:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        value = self.backing[key]
+        self.remember(key, value)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            self[key]  # type: ignore
+            return True
+        except KeyError:
+            return False
+
+    def __setitem__(self, key: str, value: Any):
+        self.backing[key] = value
+        self.remember(key, value)
+
+    def __delitem__(self, key: str):
+        with self.lock:
+            self.memory.pop(key, None)
+        del self.backing[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.backing)
+
+    def __len__(self) -> int:
+        return len(self.backing)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        self.backing.clear()
+
+
+class ShardedSQLiteCache(BaseCache):
+    def __init__(self, path: str = HTTP_CACHE_PATH, shards: int = HTTP_CACHE_SHARDS, **kwargs: Any) -> None:
+        kwargs.setdefault('suppress_warnings', True)
+        super().__init__(**kwargs)
+        paths = [f"{path}-{i}.sqlite" for i in range(shards)]
+        for shardPath in paths:
+            enableWal(shardPath)
+        self.responses = ShardedDict([DbPickleDict(p, table_name='responses', **kwargs) for p in paths])
+        self.redirects = ShardedDict([DbDict(p, table_name='redirects', **kwargs) for p in paths])
+
+    def remove_expired_responses(self, *args: Any, **kwargs: Any):
+        super().remove_expired_responses(*args, **kwargs)
+        self.responses.vacuum()
+        self.redirects.vacuum()
+
+
+def withMemoryTier(cache: BaseCache, size: int) -> BaseCache:
+    if size > 0:
+        cache.responses = TieredDict(cache.responses, size)
+        cache.redirects = TieredDict(cache.redirects, size)
+    return cache
+
+
+def createCache(backend: str = HTTP_CACHE_BACKEND, memoryTier: int = HTTP_CACHE_MEMORY_TIER) -> BaseCache:
+    # called once per process, neither sqlite connections nor mongo clients survive a fork
+    if backend == 'memory':
+        return BaseCache()
+    if backend == 'mongo':
+        cache = MongoCache('http_cache', connection=MongoClient('mongo', 27017, connect=False),
+                           suppress_warnings=True)
+    elif backend == 'sqlite':
+        cache = ShardedSQLiteCache()
+    else:
+        raise ValueError(f"unknown http cache backend {backend}")
+    return withMemoryTier(cache, memoryTier)
+
+
+def fakeResponse(i: int) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.url = f"https://api.brightsky.dev/weather?id={i}"
+    response._content = b'{"weather": []}' * 500
+    response.request = requests.Request('GET', response.url).prepare()
+    return response
+
+
+def benchmarkWriter(name: str, writer: int, count: int, results: Any):
+    cache = benchmarkCaches()[name]()
+    response = fakeResponse(writer)
+    stores: List[float] = []
+    lookups: List[float] = []
+    for i in range(count):
+        key = f"{writer}-{i}"
+        t1 = time.perf_counter()
+        cache.save_response(key, response, 60)
+        t2 = time.perf_counter()
+        cache.get_response(key)
+        t3 = time.perf_counter()
+        stores.append(t2 - t1)
+        lookups.append(t3 - t2)
+    results.put((stores, lookups))
+
+
+def benchmarkCaches() -> Dict[str, Any]:
+    path = '/tmp/http_cache_benchmark'
+    return {
+        'sqlite (wal, single file)': lambda: ShardedSQLiteCache(f"{path}-single", 1),
+        'sqlite (wal, sharded)': lambda: ShardedSQLiteCache(f"{path}-sharded"),
+        'sqlite (wal, sharded) + memory': lambda: withMemoryTier(ShardedSQLiteCache(f"{path}-sharded"), HTTP_CACHE_MEMORY_TIER),
+        'mongo': lambda: createCache('mongo', 0),
+    }
+
+
+def benchmark(writers: int = 8, count: int = 200):
+    for name in benchmarkCaches():
+        results: Any = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=benchmarkWriter, args=(name, w, count, results)) for w in range(writers)]
+        try:
+            for process in processes:
+                process.start()
+            stores: List[float] = []
+            lookups: List[float] = []
+            for _ in processes:
+                s, l = results.get(timeout=120)
+                stores += s
+                lookups += l
+        except Exception as e:
+            logging.error(f"{name}: {e}")
+            continue
+        finally:
+            for process in processes:
+                process.join(1)
+        stores.sort()
+        lookups.sort()
+        logging.info(f"{name}: store avg {sum(stores) / len(stores) * 1000:.2f}ms p95 {stores[int(len(stores) * 0.95)] * 1000:.2f}ms, "
+                     f"lookup avg {sum(lookups) / len(lookups) * 1000:.2f}ms p95 {lookups[int(len(lookups) * 0.95)] * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    benchmark()
@@ -1,6 +1,6 @@
 
 import json
-from queue import Empty
+from queue import Empty, Queue
 import time
 from telegram.ext import (Updater,
                           CommandHandler,
@@ -27,21 +27,42 @@ from typing import (Any, ContextManager, Dict, Literal, Optional, Union,
 from telegram.files.inputmedia import InputMediaAnimation, InputMediaDocument, InputMediaPhoto, InputMediaVideo
 from telegram.inline.inlinequeryresultphoto import InlineQueryResultPhoto
 from telegram.inline.inlinequeryresultmpeg4gif import InlineQueryResultMpeg4Gif
+from telegram.inline.inlinequeryresultcachedphoto import InlineQueryResultCachedPhoto
+from telegram.inline.inlinequeryresultcachedmpeg4gif import InlineQueryResultCachedMpeg4Gif
+from telegram.error import BadRequest
 from telegram.message import Message
 from telegram.utils.types import JSONDict
-from backend import Backend, Location, State, StateType, getRequestsCache
-from radar import Radar, printTime
-from weatherProvider import WeatherProvider
+from backend import Backend, Location, State, StateType, getRequestsCache, logConnectionStats
+from radar import Radar, prewarmBaseMaps, printTime, snapLocation
+from rServer import RServerPool
+from renderPool import RenderPool, mapFuture
+from renderStore import RenderStore
+from fileIdCache import FileIdCache
+import resources
+from singleFlight import SingleFlight
+from ttlCache import TTLCache, resolvedFuture
+from weatherProvider import Station, WeatherProvider, currentPlotHour
 import threading
 import functools
 from threading import Thread
-from multiprocessing import Queue, Pool, pool
 from time import sleep
 from urllib import parse
+import requests
 from dataclasses import dataclass
 import concurrent.futures
+import multiprocessing
 
-CACHING_TIME = 10 * 60
+CACHE_SIZE = 512
+CACHE_TTLS: Dict[str, float] = {
+    'plot': 20 * 60,
+    'plotTenDays': 60 * 60,
+    'radar': 5 * 60,
+}
+# how long an expired entry is still served while it is re-rendered in the background
+STALE_TIME = 10 * 60
+STATS_INTERVAL = 10 * 60
+STATION_CACHE_SIZE = 10000
+FILE_ID_CACHE_SIZE = 4096
 
 
 class ButtonQuery(TypedDict):
@@ -74,6 +95,7 @@ class UploadImageResult(TypedDict):
 class UploadAnimationResult(TypedDict):
     id: str
     link: str
+    thumb: str
 
 
 QueryType = Literal['plot', 'plotTenDays', 'radar']
@@ -92,19 +114,77 @@ def getLocationName(lat: float, lon: float) -> str:
     return res
 
 
-@functools.lru_cache(typed=False)
-def getImage(lat: float, lon: float, tenDays: bool) -> Optional[ImageResult]:
+stations: Dict[Tuple[float, float], Station] = {}
 
-    imageResult = WeatherProvider().fetchAndPlot(lat, lon, 10 if tenDays else 1.5)
-    logging.info(f'image result: {imageResult}')
+
+def resolveStation(lat: float, lon: float) -> Optional[Station]:
+    key = (lat, lon)
+    if key not in stations:
+        station = WeatherProvider().getStation(lat, lon)
+        if station == None:
+            return None
+        if len(stations) >= STATION_CACHE_SIZE:
+            stations.clear()
+        stations[key] = station
+    return stations[key]
+
+
+def withDistance(imageResult: Optional[ImageResult], distance: float) -> Optional[ImageResult]:
+    # rendered plots are shared per station, the distance belongs to the requested location
     if imageResult == None:
         return None
+    return cast(ImageResult, {**imageResult, 'weather_station_distance': distance})
+
+
+class UploadError(Exception):
+    pass
 
-    url = "http://image-host/image"
-    files = {'image': imageResult['plot'].getvalue()}
 
-    uploadResponse = getRequestsCache().request("POST", url, files=files)
-    uploadJson = cast(UploadImageResult, uploadResponse.json())
+def upload(files: Dict[str, Any]) -> Dict[str, Any]:
+    """Uploads artifacts in one request to the image-host batch endpoint.
+
+    Keys are 'image:<name>', 'animation:<name>' and 'poster:<name>', the results are keyed by name.
+    Raises UploadError if any artifact was not stored, so a failed upload is never cached."""
+    uploadResponse = getRequestsCache().request("POST", "http://image-host/batch", files=files)
+    if uploadResponse.status_code != 201:
+        raise UploadError(f"upload failed with {uploadResponse.status_code}: {uploadResponse.text}")
+    results = uploadResponse.json()['results']
+    names = {field.partition(':')[2] for field in files if not field.startswith('poster:')}
+    for name in names:
+        result = results.get(name)
+        if result == None or 'error' in result:
+            raise UploadError(f"upload of {name} failed: {result['error'] if result != None else 'missing'}")
+    return results
+
+
+def uploadExists(link: str) -> bool:
+    # with a disk quota the image-host may evict an upload before UPLOAD_MAX_AGE
+    try:
+        response = getRequestsCache().head(f"http://image-host{parse.urlparse(link).path}")
+    except requests.RequestException as e:
+        logging.error(f"could not check upload {link}: {e}")
+        return True
+    return response.status_code == 200
+
+
+def getImage(station: Station, tenDays: bool) -> Optional[ImageResult]:
+
+    imageResult = WeatherProvider().fetchAndPlot(station, 10 if tenDays else 1.5)
+    logging.info(f'image result: {imageResult}')
+    if imageResult == None:
+        return None
+
+    renderStore = RenderStore()
+    uploadJson = cast(Optional[UploadImageResult], renderStore.getUpload(imageResult['plotKey']))
+    if uploadJson != None and not uploadExists(uploadJson['link']):
+        logging.info(f"upload {uploadJson['id']} was evicted, uploading again")
+        uploadJson = None
+    if uploadJson == None:
+        uploadJson = cast(UploadImageResult, upload({'image:plot': imageResult['plot'].getvalue()})['plot'])
+        renderStore.putUpload(imageResult['plotKey'], cast(Dict[str, Any], uploadJson))
+    else:
+        logging.info(f"reusing upload {uploadJson['id']}")
+    logConnectionStats()
     return {
         'imageId': uploadJson['id'],
         'imageLink': uploadJson['link'],
@@ -119,24 +199,13 @@ def getImage(lat: float, lon: float, tenDays: bool) -> Optional[ImageResult]:
     }
 
 
-@functools.lru_cache(typed=False)
-def getRadarAnimation(lat: float, lon: float) -> Tuple[str, str]:
-    radarIO = Radar().createRadarAnimation(lat, lon)
+def getRadarAnimation(lat: float, lon: float) -> Tuple[str, str, str]:
+    animation = Radar().createRadarAnimation(lat, lon)
 
-    url = "http://image-host/animation"
-    files = {'animation': radarIO.getvalue()}
-    uploadResponse = getRequestsCache().request("POST", url, files=files)
-    uploadJson = cast(UploadAnimationResult, uploadResponse.json())
-    return (uploadJson['id'], uploadJson['link'])
-
-
-def clearImageCache():
-    logging.info("clearing lru caches")
-    logging.info(getImage.cache_info())
-    logging.info(getRadarAnimation.cache_info())
-    getImage.cache_clear()
-    getRadarAnimation.cache_clear()
-    threading.Timer(CACHING_TIME, clearImageCache).start()
+    files = {'animation:radar': animation.video.getvalue(), 'poster:radar': animation.poster}
+    uploadJson = cast(UploadAnimationResult, upload(files)['radar'])
+    logConnectionStats()
+    return (uploadJson['id'], uploadJson['link'], uploadJson['thumb'])
 
 
 @dataclass
@@ -152,109 +221,146 @@ class QueueElement:
     current_temp: Optional[float]
 
 
-def queueImage(param: QueryParameter):
-    imageResult = getImage(param.location.lat, param.location.lon, param.type == 'plotTenDays')
-    if imageResult != None:
-        logging.info(f"queueing {imageResult['imageId']}.")
-        if param.query == None:
-            text = f"Weather for station {imageResult['weather_station']}."
-        else:
-            text = f"Weather for station {imageResult['weather_station']}. Searched for '{param.query}'."
-        createResults.queue.put(
-            QueueElement(
-                type='photo',
-                id=imageResult['imageId'],
-                url=imageResult['imageLink'],
-                thumb_url=imageResult['thumbLink'],
-                height=imageResult['height'],
-                width=imageResult['width'],
-                text=text,
-                title=imageResult['weather_station'],
-                current_temp=imageResult['current_temp']
-            )
-        )
+def createImageResult(param: QueryParameter, imageResult: Optional[ImageResult]) -> Optional[QueueElement]:
+    if imageResult == None:
+        return None
+    logging.info(f"queueing {imageResult['imageId']}.")
+    if param.query == None:
+        text = f"Weather for station {imageResult['weather_station']}."
+    else:
+        text = f"Weather for station {imageResult['weather_station']}. Searched for '{param.query}'."
+    return QueueElement(
+        type='photo',
+        id=imageResult['imageId'],
+        url=imageResult['imageLink'],
+        thumb_url=imageResult['thumbLink'],
+        height=imageResult['height'],
+        width=imageResult['width'],
+        text=text,
+        title=imageResult['weather_station'],
+        current_temp=imageResult['current_temp']
+    )
 
 
-def queueRadar(param: QueryParameter):
-    radarId, link = getRadarAnimation(param.location.lat, param.location.lon)
-    locationName = getLocationName(param.location.lat, param.location.lon)
+def createRadarResult(param: QueryParameter, radar: Tuple[str, str, str], locationName: str) -> QueueElement:
+    radarId, link, thumb = radar
     logging.info(f"queueing radar {radarId}.")
     if param.query == None:
         text = f"Radar for {locationName}."
     else:
         text = f"Radar for {locationName}. Searched for '{param.query}'."
-    createResults.queue.put(
-        QueueElement(
-            type='animation',
-            id=radarId,
-            url=link,
-            thumb_url=link,
-            height=512,
-            width=512,
-            text=text,
-            title=locationName,
-            current_temp=None
-        )
+    return QueueElement(
+        type='animation',
+        id=radarId,
+        url=link,
+        thumb_url=thumb,
+        height=512,
+        width=512,
+        text=text,
+        title=locationName,
+        current_temp=None
     )
 
 
-def createResults(param: QueryParameter):
-    if param.type == 'plot' or param.type == 'plotTenDays':
-        queueImage(param)
-    else:
-        queueRadar(param)
-
-
-def setQueueForProcess(q: Queue):
-    createResults.queue = q
+def initRenderWorker():
+    logging.info(f"render worker {os.getpid()} started")
 
 
 class MainBot:
     db: Backend
 
+    renderPool: RenderPool
+    renderCache: TTLCache
+    renderFlights: SingleFlight
+    fileIds: FileIdCache
+
     inlineQueues: Dict[str, "Queue[Optional[QueueElement]]"] = {}
     inlineSentResultIds: Dict[str, List[str]] = {}
-    inlinePools: Dict[str, pool.Pool] = {}
+    inlineFutures: Dict[str, List[concurrent.futures.Future]] = {}
     activeInlineUsers: Dict[int, str] = {}
 
-    def __init__(self, db: Backend) -> None:
+    def __init__(self, db: Backend, renderPool: RenderPool) -> None:
         self.db = db
+        self.renderPool = renderPool
+        self.renderCache = TTLCache(CACHE_SIZE, STALE_TIME)
+        self.renderFlights = SingleFlight()
+        self.fileIds = FileIdCache(FILE_ID_CACHE_SIZE)
+
+    def logCacheStats(self):
+        logging.info(f"render cache: {self.renderCache.info()}")
+        logging.info(f"render flights: {self.renderFlights.info()}")
+        logging.info(f"telegram file ids: {self.fileIds.info()}")
+        logging.info(f"chat cache: {self.db.cacheInfo()}")
+        logging.info(f"resources: {resources.info()}")
+        logConnectionStats(force=True)
+        threading.Timer(STATS_INTERVAL, self.logCacheStats).start()
+
+    def requestImage(self, lat: float, lon: float, tenDays: bool) -> concurrent.futures.Future:
+        station = resolveStation(lat, lon)
+        if station == None:
+            return resolvedFuture(None)
+        type: QueryType = 'plotTenDays' if tenDays else 'plot'
+        key = (type, station['id'])
+        version = currentPlotHour()
+        future = self.renderCache.get(key, CACHE_TTLS[type],
+                                      lambda: self.renderFlights.do((key, version),
+                                                                    lambda: self.renderPool.submit(getImage, station, tenDays)),
+                                      version=version)
+        return mapFuture(future, lambda imageResult: withDistance(imageResult, station['distance']))
+
+    def requestRadar(self, lat: float, lon: float) -> concurrent.futures.Future:
+        lat, lon = snapLocation(lat, lon)
+        key = ('radar', lat, lon)
+        return self.renderCache.get(key, CACHE_TTLS['radar'],
+                                    lambda: self.renderFlights.do(key, lambda: self.renderPool.submit(getRadarAnimation, lat, lon)))
+
+    def requestResult(self, param: QueryParameter) -> concurrent.futures.Future:
+        lat, lon = param.location.lat, param.location.lon
+        if param.type == 'radar':
+            future = self.requestRadar(lat, lon)
+            # resolve the name here, the mapping runs in the pool's result thread
+            locationName = getLocationName(lat, lon)
+            return mapFuture(future, lambda radar: createRadarResult(param, radar, locationName))
+        future = self.requestImage(lat, lon, param.type == 'plotTenDays')
+        return mapFuture(future, lambda imageResult: createImageResult(param, imageResult))
 
     def start(self, update: Update, context: CallbackContext):
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Send me locations and I will answer with the weather.\nOr you can /add your favorite weather stations for quick weather access.\n\nYou can also mention me with @weatherstuffbot and send weather reports to any chat you like.")
 
     def sendRadar(self, chat_id: Union[int, str], bot: Bot, lat: float, lon: float):
+        self.db.flushStates()
         waitingMessage = bot.send_message(chat_id, text="⏳", reply_markup=ReplyKeyboardRemove())
         try:
-            _, link = getRadarAnimation(lat, lon)
+            radarId, link, _ = self.requestRadar(lat, lon).result()
             if link == None:
                 bot.send_message(chat_id, text="Could not create the radar. 😔")
                 return
 
             locationText = getLocationName(lat, lon)
 
-            bot.send_animation(chat_id,
-                               animation=link,
-                               caption=f"Radar for {locationText}",
-                               reply_markup=ReplyKeyboardRemove())
+            self.fileIds.send(radarId, link, lambda animation: bot.send_animation(chat_id,
+                                                                                  animation=animation,
+                                                                                  caption=f"Radar for {locationText}",
+                                                                                  reply_markup=ReplyKeyboardRemove()))
         finally:
             bot.delete_message(chat_id=chat_id, message_id=waitingMessage.message_id)
 
     def sendForecast(self, chat_id: Union[int, str], bot: Bot, lat: float, lon: float, tenDays: bool, name: str = None):
         waitingMessage = bot.send_message(chat_id, text="⏳", reply_markup=ReplyKeyboardRemove())
         try:
-            result = getImage(lat, lon, tenDays)
+            result = self.requestImage(lat, lon, tenDays).result()
             if result == None:
                 bot.send_message(chat_id, text="The location has no weather station nearby.")
                 return
 
             station_text = f"forecast for {name}." if (
                 name != None) else f"forecast for {result['weather_station']} ({result['weather_station_distance']}km from location)."
-            bot.send_photo(chat_id,
-                           photo=result['imageLink'],
-                           caption=f"{result['duration']} day {station_text}\nCurrently it is {result['current_temp']}°C and {result['current_str']}.",
-                           reply_markup=ReplyKeyboardRemove())
+            caption = f"{result['duration']} day {station_text}\nCurrently it is {result['current_temp']}°C and {result['current_str']}."
+            self.fileIds.send(result['imageId'], result['imageLink'], lambda photo: bot.send_photo(chat_id,
+                                                                                                 photo=photo,
+                                                                                                 caption=caption,
+                                                                                                 reply_markup=ReplyKeyboardRemove()))
         finally:
             bot.delete_message(chat_id=chat_id, message_id=waitingMessage.message_id)
 
@@ -280,28 +386,44 @@ class MainBot:
             context.bot.send_message(chat_id, f"Station '{name}' is already added.")
 
     def sendAllForLocation(self, context: CallbackContext, chat_id: str, location: Location):
+        self.db.flushStates()
         waitingMessage = context.bot.send_message(chat_id, text="⏳", reply_markup=ReplyKeyboardRemove())
         try:
-            album: List[InputMedia] = []
+            photos: List[QueueElement] = []
             params = map(lambda t: QueryParameter(location, None, t), ['plot', 'plotTenDays', 'radar'])  # type: ignore
-            queue: Queue[QueueElement] = Queue()
-            with Pool(3, setQueueForProcess, [queue]) as pool:
-                pool.map(createResults, params)
+            futures = [self.requestResult(param) for param in params]
 
-            first = True
-            while not queue.empty():
-                elem = queue.get_nowait()
+            for future in futures:
+                elem = future.result()
+                if elem == None:
+                    continue
                 logging.info(f"dequeue {elem.type}: {elem}")
                 if elem.type == 'photo':
-                    if first:
-                        album.append(InputMediaPhoto(elem.url, caption=f"Weather for {location.name}. ({elem.current_temp}°C currently)"))
-                        first = False
-                    else:
-                        album.append(InputMediaPhoto(elem.url))
+                    photos.append(elem)
                 else:
-                    context.bot.send_animation(chat_id, animation=elem.url, caption=f"Radar for {location.name}.")
-            logging.info(f"album: {album}")
-            context.bot.send_media_group(chat_id, album)
+                    self.fileIds.send(elem.id, elem.url, lambda animation: context.bot.send_animation(
+                        chat_id, animation=animation, caption=f"Radar for {location.name}."))
+
+            def album(useFileIds: bool) -> List[InputMedia]:
+                media: List[InputMedia] = []
+                for elem in photos:
+                    photo = (self.fileIds.get(elem.id) if useFileIds else None) or elem.url
+                    if len(media) == 0:
+                        media.append(InputMediaPhoto(photo, caption=f"Weather for {location.name}. ({elem.current_temp}°C currently)"))
+                    else:
+                        media.append(InputMediaPhoto(photo))
+                return media
+
+            if len(photos) == 0:
+                return
+            logging.info(f"album: {album(True)}")
+            try:
+                messages = context.bot.send_media_group(chat_id, album(True))
+            except BadRequest as e:
+                logging.warning(f"album with cached file ids rejected, sending the urls: {e}")
+                messages = context.bot.send_media_group(chat_id, album(False))
+            for elem, message in zip(photos, messages):
+                self.fileIds.remember(elem.id, message)
         finally:
             context.bot.delete_message(chat_id=chat_id, message_id=waitingMessage.message_id)
 
@@ -397,10 +519,14 @@ class MainBot:
         return
 
     def handleLocation(self, update: Update, context: CallbackContext):
+        with self.db.coalescedStates():
+            self.handleLocationMessage(update, context)
+
+    def handleLocationMessage(self, update: Update, context: CallbackContext):
         chat_id, message = self.getStuff(update)
         lat = message.location.latitude
         lon = message.location.longitude
-        if db.getState(chat_id)['type'] == 'add':  # type: ignore
+        if db.getState(chat_id).type == 'add':
             self.addLocation(chat_id, context, lat, lon)
             db.setState(chat_id, State('idle'))
         else:
@@ -413,6 +539,11 @@ class MainBot:
         context.bot.send_message(chat_id, text="Ok, now send a location.")
 
     def handleText(self, update: Update, context: CallbackContext):
+        # a message may change the state several times, only the last one is written
+        with self.db.coalescedStates():
+            self.handleTextMessage(update, context)
+
+    def handleTextMessage(self, update: Update, context: CallbackContext):
         chat_id, message = self.getStuff(update)
         state = db.getState(chat_id)
         db.setState(chat_id, State('idle'))
@@ -540,19 +671,47 @@ class MainBot:
         location = self.queryLocations(query)[0]
         types: List[QueryType] = ['plot', 'plotTenDays', 'radar']
         params = map(lambda t: QueryParameter(location, query, t), types)  # type: ignore
-        with Pool(3, setQueueForProcess, [self.inlineQueues[queryId]]) as pool:
-            self.inlinePools[queryId] = pool
-            pool.map(createResults, params)
-            del self.inlinePools[queryId]
+        queue = self.inlineQueues[queryId]
+        futures = [self.requestResult(param) for param in params]
+        self.inlineFutures[queryId] = futures
+        for future in futures:
+            future.add_done_callback(functools.partial(self.queueInlineResult, queue))
+        concurrent.futures.wait(futures)
+        if queryId in self.inlineFutures:
+            del self.inlineFutures[queryId]
 
         logging.info('inline queuing None, finished.')
-        self.inlineQueues[queryId].put(None)
+        queue.put(None)
         sleep(5)
         logging.info(f"inline deleting queue {queryId}")
         if queryId in self.inlineQueues:
             del self.inlineQueues[queryId]
 
+    def queueInlineResult(self, queue: "Queue[Optional[QueueElement]]", future: concurrent.futures.Future):
+        if future.cancelled() or future.exception() != None:
+            return
+        elem = future.result()
+        if elem != None:
+            queue.put(elem)
+
     def queueElementToResult(self, elem: QueueElement) -> InlineQueryResult:
+        # media telegram already has is answered by file_id, it does not fetch it from the image-host again
+        fileId = self.fileIds.get(elem.id)
+        if fileId != None and elem.type == 'photo':
+            return InlineQueryResultCachedPhoto(
+                id=elem.id,
+                photo_file_id=fileId,
+                description=elem.text,
+                caption=elem.text,
+                title=elem.title,
+            )
+        if fileId != None:
+            return InlineQueryResultCachedMpeg4Gif(
+                id=elem.id,
+                mpeg4_file_id=fileId,
+                caption=elem.text,
+                title=elem.title,
+            )
         if elem.type == 'photo':
             return InlineQueryResultPhoto(
                 id=elem.id,
@@ -580,9 +739,10 @@ class MainBot:
         logging.info(f'stopping {qid}')
         if qid in self.inlineSentResultIds:
             del self.inlineSentResultIds[qid]
-        if qid in self.inlinePools:
-            self.inlinePools[qid].terminate()
-            del self.inlinePools[qid]
+        if qid in self.inlineFutures:
+            for future in self.inlineFutures[qid]:
+                future.cancel()
+            del self.inlineFutures[qid]
         if qid in self.inlineQueues:
             del self.inlineQueues[qid]
 
@@ -596,7 +756,7 @@ class MainBot:
         # logging.info(f"""
         # -----------------------------------
         # '{offset}':
-        # pools: {list(self.inlinePools.keys())}
+        # futures: {list(self.inlineFutures.keys())}
         # queues: {list(self.inlineQueues.keys())}
         # users: {list(self.activeInlineUsers.keys())}
         # """)
@@ -660,8 +820,18 @@ class MainBot:
 
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
     db = Backend()
-    bot = MainBot(db)
+    # created once here, the render workers inherit them when they fork
+    resources.warm('timezoneFinder', 'compositor')
+    # fork the render workers before any other threads are started
+    renderPool = RenderPool(initializer=initRenderWorker)
+    locations = [(location.lat, location.lon) for location in db.getAllLocations()]
+    multiprocessing.Process(target=prewarmBaseMaps, args=(locations,), daemon=True).start()
+    rServers = RServerPool()
+    rServers.start()
+    bot = MainBot(db, renderPool)
 
     TOKEN = os.environ.get('BOT_TOKEN')
     if TOKEN == None:
@@ -673,8 +843,6 @@ if __name__ == '__main__':
     updater = Updater(token=TOKEN, workers=2)
     dispatcher = updater.dispatcher
 
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                        level=logging.INFO)
 
     commands = [
         ['start', bot.start, 'Send the description text'],
@@ -695,6 +863,6 @@ if __name__ == '__main__':
     dispatcher.add_error_handler(bot.handleError)
     updater.bot.set_my_commands([(name, desc) for name, _, desc in commands])
 
-    clearImageCache()
+    bot.logCacheStats()
 
     updater.start_polling()
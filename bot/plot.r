@@ -3,6 +3,8 @@ library(jsonlite)
 library(wesanderson)
 library(gridExtra)
 library(lubridate)
+library(ragg)
+library(jpeg)
 
 findExtrema <- function(data, regex, offset) {
     xc <- paste(as.character(sign(diff(data))), collapse="")
@@ -19,9 +21,7 @@ findValleys <- function(data) {
     return(findExtrema(data, "[-]{2}.{4}[+]{2}", 6))
 }
 
-plot <- function(inputFile, outputFile, tenDays) {
-    forecast <- fromJSON(inputFile)
-
+createPlot <- function(forecast, tenDays) {
     customTheme <- (
                 theme_minimal() +
                 theme(
@@ -56,13 +56,14 @@ plot <- function(inputFile, outputFile, tenDays) {
 
     if (!is.null(forecast$temps)) {
         tempsFrame <- as.data.frame(forecast$temps)
-        peaks <- findPeaks(tempsFrame$temps)
+        # the extrema are precomputed in python, findPeaks/findValleys are the fallback
+        peaks <- if (!is.null(forecast$extrema)) as.integer(unlist(forecast$extrema$peaks)) else findPeaks(tempsFrame$temps)
         peakFrame <- data.frame(
             temps=tempsFrame$temps[peaks],
             dates=tempsFrame$dates[peaks],
             label=sprintf("%d°C", round(tempsFrame$temps[peaks]))
         )
-        valleys <- findValleys(tempsFrame$temps)
+        valleys <- if (!is.null(forecast$extrema)) as.integer(unlist(forecast$extrema$valleys)) else findValleys(tempsFrame$temps)
         valleyFrame <- data.frame(
             temps=tempsFrame$temps[valleys],
             dates=tempsFrame$dates[valleys],
@@ -117,11 +118,32 @@ plot <- function(inputFile, outputFile, tenDays) {
     }
 
     if (!is.null(plotTemps) && !is.null(plotRain) && !is.null(plotSun)) {
-        g <- grid.arrange(plotTemps, plotRain, plotSun, ncol=1)
+        return(arrangeGrob(plotTemps, plotRain, plotSun, ncol=1))
+    }
+    print('not all plots')
+    return(NULL)
+}
+
+plot <- function(inputFile, outputFile, tenDays) {
+    g <- createPlot(fromJSON(inputFile), tenDays)
+    if (!is.null(g)) {
         ggsave(file=outputFile, g, width=10, height=10)
-    } else {
-        print('not all plots')
     }
 }
 
+# same output as plot, but takes the data frames directly and returns the jpeg as raw vector
+plotRaw <- function(temps, rainFallAmount, sunshine, rainfallProb, peaks, valleys, tenDays) {
+    forecast <- list(temps=temps, rainFallAmount=rainFallAmount, sunshine=sunshine, rainfallProb=rainfallProb,
+                     extrema=list(peaks=peaks, valleys=valleys))
+    g <- createPlot(forecast, tenDays)
+    if (is.null(g)) {
+        return(raw())
+    }
+    capture <- agg_capture(width=10, height=10, units='in', res=300)
+    grid::grid.draw(g)
+    image <- capture(native=TRUE)
+    invisible(dev.off())
+    return(writeJPEG(image, target=raw(), quality=0.75))
+}
+
 # plot('data.json', 'image.jpg', TRUE)
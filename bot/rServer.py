@@ -0,0 +1,277 @@
+import fcntl
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Dict, List, Optional, Set, TextIO, Tuple
+
+R_SERVERS = int(os.environ.get('R_SERVERS', '2'))
+# 'memory' hands the data frames to R directly, 'file' is the old json file round trip
+PLOT_TRANSPORT = os.environ.get('PLOT_TRANSPORT', 'memory')
+R_SOCKET_DIR = os.environ.get('R_SOCKET_DIR', '/tmp/rplot')
+PLOT_TIMEOUT = 60
+PING_TIMEOUT = 5
+HEALTH_INTERVAL = 30
+
+
+def socketPath(i: int) -> str:
+    return os.path.join(R_SOCKET_DIR, f"r-{i}.sock")
+
+
+def lockPath(i: int) -> str:
+    return os.path.join(R_SOCKET_DIR, f"r-{i}.lock")
+
+
+def busyPath(i: int) -> str:
+    # exists while the server renders, its mtime is the start of the request
+    return os.path.join(R_SOCKET_DIR, f"r-{i}.busy")
+
+
+def hungPath(i: int) -> str:
+    # created by a client whose plot timed out, the monitor restarts the server
+    return os.path.join(R_SOCKET_DIR, f"r-{i}.hung")
+
+
+def removeFile(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class RServerError(Exception):
+    pass
+
+
+def printTime(s: str, t1: float, t2: float):
+    # not imported from radar, the servers do not load the bot's modules
+    logging.info(f"{s}: {(t2 - t1) * 1000}ms")
+
+
+def watchParent(parent: int):
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+
+def serve(i: int, parent: int):
+    # runs in its own process, R and plot.r are loaded once for all requests
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    # the servers are not daemonic children, they exit with the bot
+    threading.Thread(target=watchParent, args=(parent,), daemon=True).start()
+    import rpy2.robjects as robjects
+    r = robjects.r
+    r['source']('plot.r')
+
+    path = socketPath(i)
+    with Listener(path, family='AF_UNIX') as listener:
+        logging.info(f"r server {i} listening on {path}")
+        while True:
+            with listener.accept() as conn:
+                try:
+                    handle(i, conn, robjects)
+                except EOFError:
+                    pass
+                except Exception as e:
+                    logging.error(e, exc_info=True)
+
+
+def toDataFrame(robjects: Any, columns: Optional[Dict[str, List[Any]]]) -> Any:
+    if columns == None:
+        return robjects.NULL
+    vectors = {}
+    for name, values in columns.items():
+        if name in ('dates', 'label'):
+            vectors[name] = robjects.StrVector(values)
+        else:
+            vectors[name] = robjects.FloatVector(values)
+    return robjects.DataFrame(vectors)
+
+
+def plotMemory(robjects: Any, data: Dict[str, Any], hourlySun: bool) -> bytes:
+    t1 = time.perf_counter()
+    frames = [toDataFrame(robjects, data[name]) for name in ('temps', 'rainFallAmount', 'sunshine', 'rainfallProb')]
+    frames += [robjects.IntVector(data['extrema'][name]) for name in ('peaks', 'valleys')]
+    t2 = time.perf_counter()
+    printTime('r data (memory)', t1, t2)
+
+    t1 = time.perf_counter()
+    plot = bytes(robjects.globalenv['plotRaw'](*frames, hourlySun))
+    if len(plot) == 0:
+        raise RServerError('not all plots could be created')
+    t2 = time.perf_counter()
+    printTime('r plot (memory)', t1, t2)
+    return plot
+
+
+def plotFile(robjects: Any, data: Dict[str, Any], hourlySun: bool) -> bytes:
+    with tempfile.TemporaryDirectory() as directory:
+        rInFile = os.path.join(directory, 'data.json')
+        rOutFile = os.path.join(directory, 'plot.jpg')
+        t1 = time.perf_counter()
+        with open(rInFile, 'w') as outfile:
+            json.dump(data, outfile)
+        t2 = time.perf_counter()
+        printTime('r data (file)', t1, t2)
+
+        t1 = time.perf_counter()
+        robjects.globalenv['plot'](rInFile, rOutFile, hourlySun)
+        with open(rOutFile, 'rb') as infile:
+            plot = infile.read()
+        t2 = time.perf_counter()
+        printTime('r plot (file)', t1, t2)
+        return plot
+
+
+def handle(i: int, conn: Connection, robjects: Any):
+    while True:
+        request: Dict[str, Any] = conn.recv()
+        if request['type'] == 'ping':
+            conn.send({'status': 'ok'})
+            continue
+        open(busyPath(i), 'w').close()
+        try:
+            if PLOT_TRANSPORT == 'file':
+                plot = plotFile(robjects, request['data'], request['hourlySun'])
+            else:
+                plot = plotMemory(robjects, request['data'], request['hourlySun'])
+            conn.send({'status': 'ok', 'plot': plot})
+        except Exception as e:
+            logging.error(e, exc_info=True)
+            conn.send({'status': 'error', 'error': str(e)})
+        finally:
+            removeFile(busyPath(i))
+
+
+def call(i: int, request: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    with Client(socketPath(i), family='AF_UNIX') as conn:
+        conn.send(request)
+        if not conn.poll(timeout):
+            if request['type'] == 'plot':
+                open(hungPath(i), 'w').close()
+            raise RServerError(f"r server {i} timed out")
+        return conn.recv()
+
+
+def acquire(exclude: Set[int]) -> Tuple[int, TextIO]:
+    # each server renders one plot at a time, the lock files spread clients across servers
+    order = [i for i in range(R_SERVERS) if i not in exclude]
+    random.shuffle(order)
+    # servers flagged as hung are only used if all are, until the monitor restarted them
+    order.sort(key=lambda i: os.path.exists(hungPath(i)))
+    for i in order:
+        lockFile = open(lockPath(i), 'w')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return (i, lockFile)
+        except BlockingIOError:
+            lockFile.close()
+    # all busy, wait for a random one
+    lockFile = open(lockPath(order[0]), 'w')
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    return (order[0], lockFile)
+
+
+def plot(data: Any, hourlySun: bool) -> bytes:
+    failed: Set[int] = set()
+    while True:
+        i, lockFile = acquire(failed)
+        try:
+            response = call(i, {'type': 'plot', 'data': data, 'hourlySun': hourlySun}, PLOT_TIMEOUT)
+        except (OSError, EOFError) as e:
+            # crashed or restarting, the monitor brings it back
+            failed.add(i)
+            if len(failed) >= R_SERVERS:
+                raise RServerError(f"no r server available: {e}")
+            logging.warning(f"r server {i} unavailable, trying another: {e}")
+            continue
+        finally:
+            lockFile.close()
+        if response['status'] != 'ok':
+            raise RServerError(response['error'])
+        return response['plot']
+
+
+class RServerPool:
+    """Long-lived R processes that render the plots for all render workers.
+
+    The servers run rServer.py in a fresh interpreter, so they do not import or carry the bot's state,
+    and a monitor thread pings idle servers and restarts crashed or hung ones.
+    A server is hung if a client's plot timed out or it has been rendering one
+    request for longer than PLOT_TIMEOUT.
+    """
+
+    processes: List[Optional[subprocess.Popen]]
+
+    def __init__(self, size: int = R_SERVERS) -> None:
+        self.size = size
+        self.processes = [None] * size
+
+    def start(self):
+        os.makedirs(R_SOCKET_DIR, exist_ok=True)
+        for i in range(self.size):
+            self.restart(i)
+        threading.Thread(target=self.monitor, daemon=True).start()
+
+    def restart(self, i: int):
+        process = self.processes[i]
+        if process != None and process.poll() == None:
+            process.kill()
+            process.wait()
+        removeFile(socketPath(i))
+        removeFile(busyPath(i))
+        removeFile(hungPath(i))
+        t1 = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(i), str(os.getpid())])
+        self.processes[i] = process
+        while not os.path.exists(socketPath(i)) and process.poll() == None and time.perf_counter() - t1 < 60:
+            time.sleep(0.1)
+        logging.info(f"r server {i} started in {(time.perf_counter() - t1) * 1000}ms")
+
+    def healthy(self, i: int) -> bool:
+        process = self.processes[i]
+        if process == None or process.poll() != None:
+            return False
+        if os.path.exists(hungPath(i)):
+            logging.error(f"r server {i} timed out on a plot")
+            return False
+        lockFile = open(lockPath(i), 'w')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lockFile.close()
+            # busy rendering, healthy unless it is stuck in one request
+            try:
+                rendering = time.time() - os.stat(busyPath(i)).st_mtime
+            except FileNotFoundError:
+                return True
+            if rendering > PLOT_TIMEOUT:
+                logging.error(f"r server {i} has been rendering for {rendering}s")
+                return False
+            return True
+        try:
+            return call(i, {'type': 'ping'}, PING_TIMEOUT)['status'] == 'ok'
+        except Exception as e:
+            logging.error(f"r server {i} health check failed: {e}")
+            return False
+        finally:
+            lockFile.close()
+
+    def monitor(self):
+        while True:
+            time.sleep(HEALTH_INTERVAL)
+            for i in range(self.size):
+                if not self.healthy(i):
+                    logging.warning(f"restarting r server {i}")
+                    self.restart(i)
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]), int(sys.argv[2]))
@@ -1,17 +1,28 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+import functools
+import hashlib
 import io
+import math
+import os
+import shutil
+import threading
 import time
-from typing import List, Tuple, TypedDict, cast
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypedDict, cast
 from requests.models import Response
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image
 import logging
 from requests_cache.session import CachedSession
 import staticmaps
-import imageio
 from timezonefinder import TimezoneFinder
 import pytz
 
 from backend import getRequestsCache
+from frameCompositor import FrameCompositor
+import resources
+from videoEncoder import VideoEncoder
 
 
 
@@ -22,6 +33,263 @@ def printTime(s: str, t1: float, t2: float):
 
 ZOOM = 8
 SIZE = 512
+RADAR_FETCH_WORKERS = int(os.environ.get('RADAR_FETCH_WORKERS', '8'))
+# (connect, read) timeout of a single frame, a slow frame is dropped instead of delaying the animation,
+# frames are fetched without retries (NO_RETRY_PREFIXES)
+RADAR_FRAME_TIMEOUT = (3, 10)
+# 'tiles' fetches shared web mercator tiles and crops them locally, 'center' one image per location
+RADAR_MODE = os.environ.get('RADAR_MODE', 'tiles')
+TILE_SIZE = 256
+RADAR_COLOR = 2
+RADAR_OPTIONS = '1_1'
+BASE_MAP_DIR = os.environ.get('BASE_MAP_DIR', '/cache/basemaps')
+BASE_MAP_MEMORY = int(os.environ.get('BASE_MAP_MEMORY', '64'))
+# same size as the thumbnails of the plots
+POSTER_SIZE = (200, 200)
+POSTER_QUALITY = 80
+RADAR_FRAME_DIR = os.environ.get('RADAR_FRAME_DIR', '/cache/radarframes')
+# locations whose composited frames are kept in memory
+RADAR_BUFFERS = int(os.environ.get('RADAR_BUFFERS', '32'))
+# RainViewer publishes the last two hours, older frame directories belong to locations nobody requested since
+RADAR_FRAME_MAX_AGE = 3 * 60 * 60
+RADAR_FRAME_PRUNE_INTERVAL = 60 * 60
+# nearby requests share the base map and the radar, rounding to 0.01° moves the centre by up to
+# ~0.9 px east-west and ~1.4 px north-south at 50°N (1/cos(lat)) at ZOOM, base map and radar move together
+SNAP_DECIMALS = 2
+
+
+# in memory the finder is shared with the forked render workers, otherwise each opens its own files
+TIMEZONE_IN_MEMORY = os.environ.get('TIMEZONE_IN_MEMORY', '1') == '1'
+TIMEZONE_CACHE_SIZE = 1024
+
+resources.register('timezoneFinder', lambda: TimezoneFinder(in_memory=TIMEZONE_IN_MEMORY), forkSafe=TIMEZONE_IN_MEMORY)
+resources.register('compositor', lambda: FrameCompositor((SIZE, SIZE)))
+
+
+@functools.lru_cache(maxsize=TIMEZONE_CACHE_SIZE)
+def cachedTimezone(lat: float, lon: float) -> str:
+    return resources.get('timezoneFinder').timezone_at(lat=lat, lng=lon)
+
+
+def timezoneAt(lat: float, lon: float) -> str:
+    return cachedTimezone(*snapLocation(lat, lon))
+
+
+def snapLocation(lat: float, lon: float) -> Tuple[float, float]:
+    return (round(float(lat), SNAP_DECIMALS), round(float(lon), SNAP_DECIMALS))
+
+
+class BaseMapCache:
+    """OpenStreetMap backgrounds of the radar, rendered once per snapped centre.
+
+    A small in-memory LRU sits in front of PNGs on the /cache volume, which
+    are shared by all render workers and survive restarts.
+    """
+
+    memory: "OrderedDict[str, Image.Image]"
+
+    def __init__(self, directory: str = BASE_MAP_DIR, maxSize: int = BASE_MAP_MEMORY) -> None:
+        self.directory = directory
+        self.maxSize = maxSize
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def path(self, lat: float, lon: float) -> str:
+        return os.path.join(self.directory, f"{ZOOM}-{SIZE}-{lat:.{SNAP_DECIMALS}f}-{lon:.{SNAP_DECIMALS}f}.png")
+
+    def render(self, lat: float, lon: float) -> Image.Image:
+        t1 = time.perf_counter()
+        context = staticmaps.Context()
+        context.set_tile_provider(staticmaps.tile_provider_OSM)
+        context.set_center(staticmaps.create_latlng(lat, lon))
+        context.set_zoom(ZOOM)
+        mapImage = cast(Image.Image, context.render_pillow(SIZE, SIZE))
+        t2 = time.perf_counter()
+        printTime('render base map', t1, t2)
+        return mapImage
+
+    def load(self, lat: float, lon: float) -> Image.Image:
+        path = self.path(lat, lon)
+        try:
+            with Image.open(path) as stored:
+                stored.load()
+                return stored.copy()
+        except (FileNotFoundError, OSError):
+            pass
+        mapImage = self.render(lat, lon)
+        os.makedirs(self.directory, exist_ok=True)
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        mapImage.save(tmpPath, 'PNG')
+        os.replace(tmpPath, path)
+        return mapImage
+
+    def get(self, lat: float, lon: float) -> Image.Image:
+        """Returns a copy of the base map around the snapped location."""
+        lat, lon = snapLocation(lat, lon)
+        path = self.path(lat, lon)
+        with self.lock:
+            mapImage = self.memory.get(path)
+            if mapImage != None:
+                self.memory.move_to_end(path)
+                return mapImage.copy()
+        mapImage = self.load(lat, lon)
+        with self.lock:
+            self.memory[path] = mapImage
+            while len(self.memory) > self.maxSize:
+                self.memory.popitem(last=False)
+        return mapImage.copy()
+
+    def prewarm(self, locations: Iterable[Tuple[float, float]]):
+        t1 = time.perf_counter()
+        count = 0
+        for lat, lon in set(snapLocation(lat, lon) for lat, lon in locations):
+            if os.path.exists(self.path(lat, lon)):
+                continue
+            try:
+                self.load(lat, lon)
+                count += 1
+            except Exception as e:
+                logging.error(f"could not prewarm base map {lat}, {lon}: {e}")
+        t2 = time.perf_counter()
+        printTime(f'prewarm {count} base maps', t1, t2)
+
+
+baseMaps = BaseMapCache()
+
+
+def prewarmBaseMaps(locations: List[Tuple[float, float]]):
+    # runs in a background process at startup, the render workers find the maps on disk
+    os.nice(10)
+    baseMaps.prewarm(locations)
+
+
+def createPoster(image: Image.Image) -> bytes:
+    poster = image.copy()
+    poster.thumbnail(POSTER_SIZE)
+    buffer = io.BytesIO()
+    poster.save(buffer, 'JPEG', quality=POSTER_QUALITY)
+    return buffer.getvalue()
+
+
+class RadarFrameStore:
+    """Rolling buffers of composited radar frames (base map, overlay, time and
+    marker) per snapped location, keyed by the RainViewer frame url.
+
+    Frames are kept as PNG bytes in an LRU of locations in memory and on the
+    /cache volume for the other render workers. Frames that are no longer
+    published are dropped when the buffer is updated, the directories of
+    locations not updated for RADAR_FRAME_MAX_AGE are pruned.
+    """
+
+    memory: "OrderedDict[str, Dict[str, bytes]]"
+    lastPrune = 0.0
+
+    def __init__(self, directory: str = RADAR_FRAME_DIR, maxSize: int = RADAR_BUFFERS) -> None:
+        self.directory = directory
+        self.maxSize = maxSize
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def locationDir(self, lat: float, lon: float) -> str:
+        return os.path.join(self.directory, f"{ZOOM}-{SIZE}-{lat:.{SNAP_DECIMALS}f}-{lon:.{SNAP_DECIMALS}f}")
+
+    @staticmethod
+    def fileName(frame: str) -> str:
+        return f"{hashlib.sha1(frame.encode()).hexdigest()}.png"
+
+    def get(self, lat: float, lon: float, frames: List[str]) -> Dict[str, bytes]:
+        directory = self.locationDir(lat, lon)
+        with self.lock:
+            buffer = self.memory.get(directory, {})
+            found = {frame: buffer[frame] for frame in frames if frame in buffer}
+        for frame in frames:
+            if frame in found:
+                continue
+            try:
+                with open(os.path.join(directory, self.fileName(frame)), 'rb') as f:
+                    found[frame] = f.read()
+            except FileNotFoundError:
+                pass
+        return found
+
+    def prune(self):
+        now = time.time()
+        if now - RadarFrameStore.lastPrune < RADAR_FRAME_PRUNE_INTERVAL:
+            return
+        RadarFrameStore.lastPrune = now
+        pruned = 0
+        for entry in os.scandir(self.directory):
+            try:
+                # adding or removing a frame touches the directory, it is fresh while the location is requested
+                if entry.is_dir() and now - entry.stat().st_mtime > RADAR_FRAME_MAX_AGE:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    pruned += 1
+            except FileNotFoundError:
+                pass
+        logging.info(f"pruned {pruned} radar frame directories")
+
+    def update(self, lat: float, lon: float, frames: Dict[str, bytes]):
+        directory = self.locationDir(lat, lon)
+        os.makedirs(directory, exist_ok=True)
+        self.prune()
+        names = {self.fileName(frame): png for frame, png in frames.items()}
+        for name in os.listdir(directory):
+            if name not in names and not name.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        for name, png in names.items():
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                tmpPath = f"{path}.{os.getpid()}.tmp"
+                try:
+                    with open(tmpPath, 'wb') as f:
+                        f.write(png)
+                    os.replace(tmpPath, path)
+                except FileNotFoundError:
+                    # another worker pruned the directory, the frames stay in memory
+                    break
+        with self.lock:
+            self.memory[directory] = frames
+            self.memory.move_to_end(directory)
+            while len(self.memory) > self.maxSize:
+                self.memory.popitem(last=False)
+
+
+radarFrames = RadarFrameStore()
+
+
+def tileWindow(lat: float, lon: float) -> Tuple[int, int, List[Tuple[int, int]]]:
+    """Global pixel position of the top left corner of the SIZE window centred
+    at the location, and the tiles at ZOOM it covers."""
+    worldSize = 2 ** ZOOM * TILE_SIZE
+    x = (lon + 180) / 360 * worldSize
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * worldSize
+    left = round(x - SIZE / 2)
+    top = round(y - SIZE / 2)
+    tiles = [(tx, ty)
+             for ty in range(top // TILE_SIZE, (top + SIZE - 1) // TILE_SIZE + 1)
+             for tx in range(left // TILE_SIZE, (left + SIZE - 1) // TILE_SIZE + 1)]
+    return (left, top, tiles)
+
+
+def stitchTiles(left: int, top: int, tiles: List[Tuple[int, int]], images: List[Optional[Image.Image]]) -> Image.Image:
+    overlay = Image.new('RGBA', (SIZE, SIZE), (0, 0, 0, 0))
+    for (tx, ty), image in zip(tiles, images):
+        if image == None:
+            continue
+        with image:
+            overlay.paste(image.convert('RGBA'), (tx * TILE_SIZE - left, ty * TILE_SIZE - top))
+    return overlay
+
+
+@dataclass
+class RadarAnimation:
+    video: io.BytesIO
+    # small JPEG of the most recent observed frame, used as preview
+    poster: bytes
+
 
 class RadarElement(TypedDict):
     time: int
@@ -43,75 +311,112 @@ class WeatherMapsResult(TypedDict):
 
 class Radar:
     requestsSession: CachedSession
-    timezoneFinder: TimezoneFinder
 
     def __init__(self) -> None:
         self.requestsSession = getRequestsCache()
-        self.timezoneFinder = TimezoneFinder()
 
 
-    def getRainViewerUrls(self, lat: float, lon: float) -> List[Tuple[str, datetime]]:
+    def getRainViewerFrames(self, lat: float, lon: float) -> List[Tuple[str, datetime]]:
         response = cast(Response, self.requestsSession.get('https://api.rainviewer.com/public/weather-maps.json', expire_after=5*60))
         result: WeatherMapsResult = response.json()
         items = result['radar']['past'][-3:] + result['radar']['nowcast']
-
-        color = 2
-        options = '1_1'
+        tz = pytz.timezone(timezoneAt(lat, lon))
 
         def resultFromElement(item: RadarElement):
-            tz = self.timezoneFinder.timezone_at(lat=float(lat), lng=float(lon))
-            date = datetime.fromtimestamp(item['time'], tz=pytz.timezone(tz))
-            url = f"{result['host']}{item['path']}/{SIZE}/{ZOOM}/{lat}/{lon}/{color}/{options}.png"
-            return (url, date)
+            date = datetime.fromtimestamp(item['time'], tz=tz)
+            return (f"{result['host']}{item['path']}", date)
 
         return list(map(resultFromElement , items))
 
-    def addTimeToImage(self, mapImage: Image.Image, timestamp: datetime):
+    def fetchImage(self, url: str) -> Optional[bytes]:
+        try:
+            response = self.requestsSession.get(url, timeout=RADAR_FRAME_TIMEOUT)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            logging.warning(f"could not fetch radar image {url}: {e}")
+            return None
 
-        font = ImageFont.truetype('./FiraSans-Regular.ttf', 15)
-        text = timestamp.strftime('%Y-%m-%d %H:%M')
-        dx, dy = font.getsize(text)
-        timeImage = Image.new('RGBA', (dx + 20, dy + 20), (255, 255, 255, 128))
-        draw: ImageDraw.ImageDraw = ImageDraw.Draw(timeImage)  # type: ignore
-        draw.text((10, 10), text, fill='black', font=font)
-        mapImage.paste(timeImage, (0, 0), timeImage)
+    def fetchOverlays(self, executor: ThreadPoolExecutor, frames: List[str], lat: float, lon: float) -> List[Callable[[], Optional[Image.Image]]]:
+        """Starts the downloads, each callable waits for its frame and decodes it."""
+        if RADAR_MODE == 'center':
+            def image(future: Future) -> Optional[Image.Image]:
+                content = future.result()
+                return None if content == None else Image.open(io.BytesIO(content))
 
-    def addMarkerToImage(self, mapImage: Image.Image):
-        marker = Image.open('./marker.png').resize((23, 34))
-        x = int(mapImage.width / 2 - marker.width / 2)
-        y = int(mapImage.height / 2 - marker.height)
-        mapImage.paste(marker, (x, y), marker)
+            futures = [executor.submit(self.fetchImage, f"{frame}/{SIZE}/{ZOOM}/{lat}/{lon}/{RADAR_COLOR}/{RADAR_OPTIONS}.png")
+                       for frame in frames]
+            return [functools.partial(image, future) for future in futures]
 
-    def createRadarAnimation(self, lat: float, lon: float) -> io.BytesIO:
-        context = staticmaps.Context()
-        context.set_tile_provider(staticmaps.tile_provider_OSM)
-        location = staticmaps.create_latlng(float(lat), float(lon))
-        context.set_center(location)
-        context.set_zoom(ZOOM)
-        mapImage = cast(Image.Image, context.render_pillow(SIZE, SIZE))
+        # the tile urls do not depend on the location, so users in the same region share them in the http cache
+        left, top, tiles = tileWindow(lat, lon)
+        worldTiles = 2 ** ZOOM
+        inWorld = [(tx, ty) for tx, ty in tiles if 0 <= ty < worldTiles]
+
+        def overlay(tileFutures: List[Future]) -> Optional[Image.Image]:
+            contents = [future.result() for future in tileFutures]
+            if any(content == None for content in contents):
+                # a partial overlay would show missing rain, drop the frame instead
+                return None
+            return stitchTiles(left, top, inWorld, [Image.open(io.BytesIO(content)) for content in contents])
+
+        result = []
+        for frame in frames:
+            tileFutures = [executor.submit(self.fetchImage, f"{frame}/{TILE_SIZE}/{ZOOM}/{tx % worldTiles}/{ty}/{RADAR_COLOR}/{RADAR_OPTIONS}.png")
+                           for tx, ty in inWorld]
+            result.append(functools.partial(overlay, tileFutures))
+        return result
+
+    def createRadarAnimation(self, lat: float, lon: float) -> RadarAnimation:
+        lat, lon = snapLocation(lat, lon)
+        radars = self.getRainViewerFrames(lat, lon)
+        radars.sort(key=lambda radar: radar[1])
+        now = time.time()
+        observed = [frame for frame, timestamp in radars if timestamp.timestamp() <= now]
+        posterFrame = observed[-1] if len(observed) > 0 else None
+        poster: Optional[bytes] = None
+
+        frames = radarFrames.get(lat, lon, [frame for frame, _ in radars])
+        missing = [frame for frame, _ in radars if frame not in frames]
+        reused = len(frames)
+
+        # frames are decoded, composited and encoded one at a time, in timestamp order
+        with ThreadPoolExecutor(RADAR_FETCH_WORKERS) as executor, VideoEncoder((SIZE, SIZE)) as encoder:
+            t1 = time.perf_counter()
+            pending = dict(zip(missing, self.fetchOverlays(executor, missing, lat, lon)))
+            # the frames download while the base map is loaded
+            base = None
+            if len(missing) > 0:
+                compositor: FrameCompositor = resources.get('compositor')
+                compositor.resetTimings()
+                with baseMaps.get(lat, lon) as mapImage:
+                    base = compositor.prepare(mapImage)
+            for frame, timestamp in radars:
+                if frame in frames:
+                    image = Image.open(io.BytesIO(frames[frame]))
+                else:
+                    overlay = pending[frame]()
+                    if overlay == None or base is None:
+                        continue
+                    with overlay:
+                        image = compositor.composite(base, overlay, timestamp)
+                    png = io.BytesIO()
+                    image.save(png, 'PNG')
+                    frames[frame] = png.getvalue()
+                with image:
+                    if poster == None or frame == posterFrame:
+                        poster = createPoster(image)
+                    encoder.write(image)
+            if base is not None:
+                compositor.logTimings()
+            t2 = time.perf_counter()
+            printTime(f'radar frames ({len(missing)} new, {reused} reused, {RADAR_MODE})', t1, t2)
+            if encoder.frames == 0:
+                raise Exception('no radar frame could be downloaded')
+            video = encoder.finish()
 
-        allImages: List[Image.Image] = []
-
-        radars = self.getRainViewerUrls(lat, lon)
-        i = 0
-        for radarUrl, timestamp in radars:
-            # t1 = time.perf_counter()
-            currentImage = mapImage.copy()
-            response = self.requestsSession.get(radarUrl)
-            with Image.open(io.BytesIO(response.content)) as overlay:
-                currentImage.paste(overlay, (0, 0), overlay)
-            self.addTimeToImage(currentImage, timestamp)
-            self.addMarkerToImage(currentImage)
-            # t2 = time.perf_counter()
-            # printTime(f'{i}', t1, t2)
-            i += 1
-
-            allImages.append(currentImage.convert('RGB'))
-        mapImage.close()
-
-        buffer = io.BytesIO()
-        imageio.mimsave(buffer, allImages, 'mp4',  fps=1, output_params=["-f", "mp4"])
-        return buffer
+        radarFrames.update(lat, lon, frames)
+        return RadarAnimation(io.BytesIO(video), cast(bytes, poster))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+import concurrent.futures
+import functools
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from typing import Any, Callable, Deque, Optional, Tuple
+
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', '3'))
+
+PendingTask = Tuple[concurrent.futures.Future, Callable[..., Any], Tuple[Any, ...]]
+
+
+def mapFuture(source: concurrent.futures.Future, fn: Callable[[Any], Any]) -> concurrent.futures.Future:
+    # cancelling the mapped future also cancels the source if it has not started yet
+    mapped: concurrent.futures.Future = concurrent.futures.Future()
+
+    def onMappedDone(f: concurrent.futures.Future):
+        if f.cancelled():
+            source.cancel()
+
+    def onSourceDone(f: concurrent.futures.Future):
+        if f.cancelled():
+            mapped.cancel()
+            return
+        if not mapped.set_running_or_notify_cancel():
+            return
+        try:
+            mapped.set_result(fn(f.result()))
+        except BaseException as e:
+            mapped.set_exception(e)
+
+    mapped.add_done_callback(onMappedDone)
+    source.add_done_callback(onSourceDone)
+    return mapped
+
+
+class RenderPool:
+    """Long-lived worker processes that all render paths submit to.
+
+    Tasks wait in a local queue until a worker is free, so a future that is
+    cancelled before it started (e.g. an abandoned inline query) never reaches
+    a worker. Results are delivered per task through the returned futures.
+    If a worker dies, its tasks fail with BrokenProcessPool and the workers
+    are started again.
+    """
+
+    processes: int
+    executor: concurrent.futures.ProcessPoolExecutor
+    pending: Deque[PendingTask]
+    running: int
+
+    def __init__(self, processes: int = RENDER_WORKERS, initializer: Optional[Callable[[], None]] = None) -> None:
+        self.processes = processes
+        self.initializer = initializer
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.running = 0
+        self.executor = self.startExecutor()
+
+    def startExecutor(self) -> concurrent.futures.ProcessPoolExecutor:
+        logging.info(f"starting render pool with {self.processes} workers")
+        executor = concurrent.futures.ProcessPoolExecutor(self.processes, multiprocessing.get_context('fork'),
+                                                          initializer=self.initializer)
+        # the workers fork on the first task, start them before the bot starts its threads
+        executor.submit(int).result()
+        return executor
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self.lock:
+            self.pending.append((future, fn, args))
+        self.dispatch()
+        return future
+
+    def dispatch(self):
+        with self.lock:
+            while self.running < self.processes and len(self.pending) > 0:
+                future, fn, args = self.pending.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.running += 1
+                try:
+                    task = self.executor.submit(fn, *args)
+                except BrokenProcessPool as e:
+                    self.running -= 1
+                    future.set_exception(e)
+                    self.restart(self.executor)
+                    continue
+                task.add_done_callback(functools.partial(self.onDone, future, self.executor))
+
+    def restart(self, broken: concurrent.futures.ProcessPoolExecutor):
+        # called with the lock held, only the first failed task of a broken executor replaces it
+        if self.executor is broken:
+            logging.error("a render worker died, restarting the render pool")
+            broken.shutdown(wait=False)
+            self.executor = self.startExecutor()
+
+    def onDone(self, future: concurrent.futures.Future, executor: concurrent.futures.ProcessPoolExecutor,
+               task: concurrent.futures.Future):
+        error = task.exception()
+        with self.lock:
+            self.running -= 1
+            if isinstance(error, BrokenProcessPool):
+                self.restart(executor)
+        if error != None:
+            logging.error(f"render task failed: {error}")
+            future.set_exception(error)
+        else:
+            future.set_result(task.result())
+        self.dispatch()
+
+    def close(self):
+        with self.lock:
+            for future, _, _ in self.pending:
+                future.cancel()
+            self.pending.clear()
+        self.executor.shutdown(wait=True)
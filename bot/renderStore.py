@@ -0,0 +1,89 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+RENDER_STORE_DIR = os.environ.get('RENDER_STORE_DIR', '/cache/renders')
+# the image-host deletes uploads after two days, with a disk quota earlier (getImage checks before reusing)
+UPLOAD_MAX_AGE = 24 * 60 * 60
+STORE_MAX_AGE = 7 * 24 * 60 * 60
+PRUNE_INTERVAL = 60 * 60
+
+
+def fileHash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class RenderStore:
+    """Persistent content-addressed store for rendered plots.
+
+    Keys are hashes of the plot input, values are the produced JPEG and, once
+    uploaded, the image-host result. Files live on the /cache volume, so the
+    store is shared by all render workers and survives restarts.
+    """
+
+    directory: str
+    # shared by all instances of the process
+    lastPrune: float = 0
+
+    def __init__(self, directory: str = RENDER_STORE_DIR) -> None:
+        self.directory = directory
+
+    @staticmethod
+    def key(data: Any, *extra: Any) -> str:
+        hash = hashlib.sha256()
+        hash.update(json.dumps(data, sort_keys=True).encode())
+        for e in extra:
+            hash.update(str(e).encode())
+        return hash.hexdigest()
+
+    def path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    def write(self, path: str, content: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        with open(tmpPath, 'wb') as f:
+            f.write(content)
+        os.replace(tmpPath, path)
+
+    def getPlot(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self.path(key, '.jpg'), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def putPlot(self, key: str, plot: bytes):
+        self.write(self.path(key, '.jpg'), plot)
+        self.prune()
+
+    def getUpload(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path(key, '.json'), 'r') as f:
+                stored = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - stored['uploaded'] > UPLOAD_MAX_AGE:
+            return None
+        return stored['upload']
+
+    def putUpload(self, key: str, upload: Dict[str, Any]):
+        self.write(self.path(key, '.json'), json.dumps({'uploaded': time.time(), 'upload': upload}).encode())
+
+    def prune(self):
+        now = time.time()
+        if now - RenderStore.lastPrune < PRUNE_INTERVAL:
+            return
+        RenderStore.lastPrune = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(path).st_mtime > STORE_MAX_AGE:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+        logging.info(f"pruned render store {self.directory}")
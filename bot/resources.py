@@ -0,0 +1,58 @@
+from dataclasses import dataclass
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+@dataclass
+class Resource:
+    factory: Callable[[], Any]
+    # fork safe resources created before the render workers fork are shared with them copy-on-write,
+    # the others (open files, connections) are created again in every process
+    forkSafe: bool
+    value: Any = None
+    pid: Optional[int] = None
+    cost: float = 0
+
+
+resources: Dict[str, Resource] = {}
+lock = threading.RLock()
+
+
+def register(name: str, factory: Callable[[], Any], forkSafe: bool = True):
+    with lock:
+        if name not in resources:
+            resources[name] = Resource(factory, forkSafe)
+
+
+def get(name: str) -> Any:
+    """Returns the shared instance of a registered resource, creating it on first use."""
+    resource = resources[name]
+    pid = os.getpid()
+    if resource.pid == pid or (resource.forkSafe and resource.pid != None):
+        return resource.value
+    with lock:
+        if resource.pid == pid or (resource.forkSafe and resource.pid != None):
+            return resource.value
+        t1 = time.perf_counter()
+        resource.value = resource.factory()
+        resource.cost = time.perf_counter() - t1
+        resource.pid = pid
+        logging.info(f"created {name} in {resource.cost * 1000}ms (process {pid})")
+        return resource.value
+
+
+def warm(*names: str):
+    """Creates the resources up front, called before the render workers fork."""
+    t1 = time.perf_counter()
+    for name in names:
+        get(name)
+    logging.info(f"warmed {', '.join(names)} in {(time.perf_counter() - t1) * 1000}ms")
+
+
+def info() -> Dict[str, Any]:
+    with lock:
+        return {name: {'created': resource.pid != None, 'pid': resource.pid, 'costMs': resource.cost * 1000}
+                for name, resource in resources.items()}
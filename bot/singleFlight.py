@@ -0,0 +1,82 @@
+import concurrent.futures
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Optional, cast
+
+
+@dataclass
+class Flight:
+    future: Optional[concurrent.futures.Future]
+    waiters: int
+
+
+def copyFuture(source: concurrent.futures.Future, target: concurrent.futures.Future):
+    if not target.set_running_or_notify_cancel():
+        return
+    if source.cancelled():
+        target.set_exception(concurrent.futures.CancelledError())
+        return
+    exception = source.exception()
+    if exception != None:
+        target.set_exception(exception)
+    else:
+        target.set_result(source.result())
+
+
+class SingleFlight:
+    """Coalesces concurrent loads of the same key into one in-flight future.
+
+    Every caller gets its own future, so cancelling it only withdraws that caller;
+    the shared load is cancelled once no caller is waiting for it anymore.
+    """
+
+    flights: Dict[Hashable, Flight]
+    started: int
+    coalesced: int
+
+    def __init__(self) -> None:
+        self.flights = {}
+        self.started = 0
+        self.coalesced = 0
+        # reentrant, a load may complete synchronously while the flight is registered
+        self.lock = threading.RLock()
+
+    def do(self, key: Hashable, load: Callable[[], concurrent.futures.Future]) -> concurrent.futures.Future:
+        waiter: concurrent.futures.Future = concurrent.futures.Future()
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight != None:
+                flight.waiters += 1
+                self.coalesced += 1
+            else:
+                flight = Flight(None, 1)
+                self.flights[key] = flight
+                self.started += 1
+                flight.future = load()
+                flight.future.add_done_callback(lambda f: self.land(key, flight))  # type: ignore
+            shared = cast(concurrent.futures.Future, flight.future)
+
+        waiter.add_done_callback(lambda f: self.release(flight, f))  # type: ignore
+        shared.add_done_callback(lambda f: copyFuture(f, waiter))
+        return waiter
+
+    def land(self, key: Hashable, flight: Flight):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def release(self, flight: Flight, waiter: concurrent.futures.Future):
+        if not waiter.cancelled():
+            return
+        with self.lock:
+            flight.waiters -= 1
+            if flight.waiters == 0 and flight.future != None:
+                flight.future.cancel()
+
+    def info(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'inFlight': len(self.flights),
+                'started': self.started,
+                'coalesced': self.coalesced,
+            }
@@ -0,0 +1,121 @@
+import concurrent.futures
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    created: float
+    ttl: float
+    version: Hashable = None
+    refreshing: bool = False
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    staleHits: int = 0
+    misses: int = 0
+    refreshes: int = 0
+    evictions: int = 0
+
+
+def resolvedFuture(value: Any) -> concurrent.futures.Future:
+    future: concurrent.futures.Future = concurrent.futures.Future()
+    future.set_result(value)
+    return future
+
+
+class TTLCache:
+    """Bounded LRU cache with a TTL per entry and stale-while-revalidate.
+
+    An entry younger than its TTL is served directly. An expired entry is still
+    served for `staleTime` seconds while a single background refresh replaces it;
+    after that it counts as a miss. An entry stored for another `version` than the
+    requested one is treated as expired. Loads are functions returning futures, so
+    the cache works on top of the render pool without blocking.
+    """
+
+    maxSize: int
+    staleTime: float
+    entries: "OrderedDict[Hashable, CacheEntry]"
+    stats: CacheStats
+
+    def __init__(self, maxSize: int, staleTime: float) -> None:
+        self.maxSize = maxSize
+        self.staleTime = staleTime
+        self.entries = OrderedDict()
+        self.stats = CacheStats()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, ttl: float, load: Callable[[], concurrent.futures.Future],
+            version: Hashable = None) -> concurrent.futures.Future:
+        now = time.monotonic()
+        refresh = False
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None:
+                age = now - entry.created
+                if age < entry.ttl and entry.version == version:
+                    self.entries.move_to_end(key)
+                    self.stats.hits += 1
+                    return resolvedFuture(entry.value)
+                if age < entry.ttl + self.staleTime:
+                    self.entries.move_to_end(key)
+                    self.stats.staleHits += 1
+                    if not entry.refreshing:
+                        entry.refreshing = True
+                        self.stats.refreshes += 1
+                        refresh = True
+                    value = entry.value
+                else:
+                    del self.entries[key]
+                    entry = None
+            if entry == None:
+                self.stats.misses += 1
+
+        if entry == None:
+            future = load()
+            future.add_done_callback(lambda f: self.onLoaded(key, ttl, version, f))
+            return future
+
+        if refresh:
+            logging.info(f"refreshing stale cache entry {key}")
+            load().add_done_callback(lambda f: self.onLoaded(key, ttl, version, f))
+        return resolvedFuture(value)
+
+    def onLoaded(self, key: Hashable, ttl: float, version: Hashable, future: concurrent.futures.Future):
+        if future.cancelled() or future.exception() != None or future.result() == None:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry != None:
+                    entry.refreshing = False
+            return
+        self.put(key, future.result(), ttl, version)
+
+    def put(self, key: Hashable, value: Any, ttl: float, version: Hashable = None):
+        with self.lock:
+            self.entries[key] = CacheEntry(value, time.monotonic(), ttl, version)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def info(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.stats.hits + self.stats.staleHits + self.stats.misses
+            return {
+                'size': len(self.entries),
+                'maxSize': self.maxSize,
+                'hits': self.stats.hits,
+                'staleHits': self.stats.staleHits,
+                'misses': self.stats.misses,
+                'refreshes': self.stats.refreshes,
+                'evictions': self.stats.evictions,
+                'hitRate': (self.stats.hits + self.stats.staleHits) / lookups if lookups > 0 else 0,
+            }
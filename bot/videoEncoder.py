@@ -0,0 +1,106 @@
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from typing import Any, List, Optional, Tuple
+
+import imageio_ffmpeg
+from PIL import Image
+
+VIDEO_CODEC = os.environ.get('VIDEO_CODEC', 'libx264')
+VIDEO_PRESET = os.environ.get('VIDEO_PRESET', 'veryfast')
+VIDEO_CRF = int(os.environ.get('VIDEO_CRF', '23'))
+# 'mp4' or any other container ffmpeg can write, telegram animations need mp4
+VIDEO_CONTAINER = os.environ.get('VIDEO_CONTAINER', 'mp4')
+
+
+class VideoEncoder:
+    """Streams frames into an ffmpeg process as they are produced.
+
+    Only the frame currently being written is held in memory, ffmpeg writes
+    the video to a temporary file which is read once at the end. The command
+    is built here, so outputParams is the only rate control ffmpeg gets.
+    """
+
+    frames: int
+    process: Optional[subprocess.Popen]
+
+    def __init__(self, size: Tuple[int, int], fps: float = 1, codec: str = VIDEO_CODEC, preset: str = VIDEO_PRESET,
+                 crf: int = VIDEO_CRF, container: str = VIDEO_CONTAINER) -> None:
+        self.size = size
+        self.fps = fps
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.container = container
+        self.frames = 0
+        self.process = None
+        self.encodeTime = 0.0
+
+    def outputParams(self) -> List[str]:
+        params = ['-f', self.container]
+        if self.codec in ('libx264', 'libx265'):
+            params += ['-preset', self.preset, '-crf', str(self.crf)]
+        elif self.codec in ('libvpx', 'libvpx-vp9', 'libaom-av1'):
+            # constant quality, without a zero bitrate these codecs treat crf as a cap
+            params += ['-crf', str(self.crf), '-b:v', '0']
+        else:
+            logging.warning(f"VIDEO_CRF does not apply to {self.codec}, ffmpeg uses the codec's default rate control")
+        if self.container == 'mp4':
+            params += ['-movflags', '+faststart']
+        return params
+
+    def command(self) -> List[str]:
+        width, height = self.size
+        return [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f"{width}x{height}", '-r', str(self.fps), '-i', '-',
+                '-an', '-vcodec', self.codec, '-pix_fmt', 'yuv420p'] + self.outputParams() + [self.path]
+
+    def __enter__(self) -> 'VideoEncoder':
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, f"video.{self.container}")
+        # errors go to a file, a full stderr pipe would block ffmpeg
+        self.log = open(os.path.join(self.directory.name, 'ffmpeg.log'), 'w+b')
+        self.process = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.log)
+        return self
+
+    def write(self, image: Image.Image):
+        # only the time spent in the encoder counts, not producing the frames in between
+        t1 = time.perf_counter()
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        assert self.process != None and self.process.stdin != None
+        try:
+            self.process.stdin.write(image.tobytes())
+        except BrokenPipeError:
+            raise IOError(f"ffmpeg stopped: {self.errors()}")
+        self.frames += 1
+        self.encodeTime += time.perf_counter() - t1
+
+    def errors(self) -> str:
+        self.log.seek(0)
+        return self.log.read().decode(errors='replace').strip()
+
+    def finish(self) -> bytes:
+        assert self.process != None and self.process.stdin != None
+        t1 = time.perf_counter()
+        self.process.stdin.close()
+        returnCode = self.process.wait()
+        self.process = None
+        if returnCode != 0:
+            raise IOError(f"ffmpeg exited with {returnCode}: {self.errors()}")
+        with open(self.path, 'rb') as f:
+            video = f.read()
+        self.encodeTime += time.perf_counter() - t1
+        logging.info(f"encoded {self.frames} frames ({self.codec}, {self.container}) in "
+                     f"{self.encodeTime * 1000}ms: {len(video)} bytes")
+        return video
+
+    def __exit__(self, *args: Any):
+        if self.process != None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+        self.log.close()
+        self.directory.cleanup()
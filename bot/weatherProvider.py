@@ -1,31 +1,45 @@
 
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-import json
+import fcntl
 import logging
-import tempfile
-from typing import Any, Optional, Tuple, TypedDict
+import os
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
 from numpy.lib import math
 from requests_cache.session import CachedSession
 import numpy as np
 import io
 import time
-from typing import Any
-import numpy as np
 from backend import getRequestsCache
 from radar import printTime
-import rpy2.robjects as robjects
+from renderStore import RenderStore, fileHash
+import rServer
 
-r = robjects.r
-r['source']('plot.r')
-rPlotFun = robjects.globalenv['plot']
+# changes to the plot script invalidate stored renders
+PLOT_VERSION = fileHash('plot.r')
 
 
 # BRIGHTSKY_SERVER = "http://brightsky_frontend:5000"
 BRIGHTSKY_SERVER = "https://api.brightsky.dev/"
 
 
+RAIN_PROPS = ['pp50', 'pp30', 'pp20', 'pp10', 'pp05', 'pp03', 'pp02', 'pp01', 'pp00']
+RAIN_AMOUNTS = np.array([5, 3, 2, 1, 0.5, 0.3, 0.2, 0.1, 0])
+VALUE_COLUMNS = ['temperature', 'precipitation', 'sunshine'] + RAIN_PROPS
+
+FORECAST_DAYS = 10
+# fetched on top of the 10 days, so the window can move forward without a refetch
+FORECAST_BUFFER_HOURS = 24
+FORECAST_TTL = 30 * 60
+CURRENT_TTL = 5 * 60
+FORECAST_STORE_SIZE = 256
+FORECAST_LOCK_DIR = os.environ.get('FORECAST_LOCK_DIR', '/tmp/forecast-locks')
+
+
 class WeatherResult(TypedDict):
     plot: io.BytesIO
+    plotKey: str
     duration: float
     current_temp: float
     current_str: str
@@ -33,147 +47,304 @@ class WeatherResult(TypedDict):
     weather_station_distance: float
 
 
+class Station(TypedDict):
+    id: str
+    name: str
+    distance: float
+
+
+def column(weather: List[Any], name: str) -> np.ndarray:
+    # missing and null values become NaN
+    return np.array([element.get(name) for element in weather], dtype=float)
+
+
+def offsetMinutes(offset: str) -> int:
+    digits = offset.replace(':', '')
+    if len(digits) < 5:
+        # 'Z' or no offset
+        return 0
+    minutes = int(digits[1:3]) * 60 + int(digits[3:5])
+    return -minutes if digits[0] == '-' else minutes
+
+
+def toColumns(weather: List[Any]) -> Dict[str, np.ndarray]:
+    # the timestamp column is parsed once per fetched forecast
+    timestamps = [element['timestamp'] for element in weather]
+    localTimes = np.array([t[:19] for t in timestamps], dtype='datetime64[s]')
+    offsets = np.array([t[19:].replace(':', '') for t in timestamps], dtype=str)
+    days = np.char.add(np.datetime_as_string(localTimes.astype('datetime64[D]')), 'T00:00:00')
+    columns = {
+        'utc': localTimes - np.array([offsetMinutes(t[19:]) for t in timestamps], dtype='timedelta64[m]'),
+        'dateTime': np.char.add(np.datetime_as_string(localTimes, unit='s'), offsets),
+        'day': np.char.add(days, offsets),
+        'condition': np.array([element.get('condition') for element in weather], dtype=object),
+    }
+    for name in VALUE_COLUMNS:
+        columns[name] = column(weather, name)
+    return columns
+
+
+def findExtrema(values: np.ndarray, peaks: bool) -> List[int]:
+    # same matches as the former regexes '[+]{2}.{4}[-]{2}' (peaks) and '[-]{2}.{4}[+]{2}'
+    # (valleys) over the signs of the differences, returned as 1-based indices for R
+    signs = np.sign(np.diff(values))
+    n = len(signs) - 7
+    if n <= 0:
+        return []
+    before, after = (1, -1) if peaks else (-1, 1)
+    candidates = np.nonzero((signs[:n] == before) & (signs[1:n + 1] == before)
+                            & (signs[6:n + 6] == after) & (signs[7:n + 7] == after))[0]
+    result = []
+    nextStart = 0
+    for start in candidates:
+        # matches of the regex do not overlap
+        if start >= nextStart:
+            result.append(int(start) + 7)
+            nextStart = start + 8
+    return result
+
+
+def prepareForecast(columns: Dict[str, np.ndarray], hourlySun: bool) -> Dict[str, Any]:
+    dateTimes = columns['dateTime']
+    days = columns['day']
+    rowCount = len(dateTimes)
+
+    temperature = columns['temperature']
+    hasTemperature = ~np.isnan(temperature)
+    temps = {
+        'dates': dateTimes[hasTemperature].tolist(),
+        'temps': temperature[hasTemperature].tolist(),
+    }
+    extrema = {
+        'peaks': findExtrema(temperature[hasTemperature], True),
+        'valleys': findExtrema(temperature[hasTemperature], False),
+    }
+
+    precipitation = columns['precipitation']
+    hasPrecipitation = ~np.isnan(precipitation)
+    rainFallAmount = {
+        'dates': dateTimes[hasPrecipitation].tolist(),
+        'amount': precipitation[hasPrecipitation].tolist(),
+    }
+
+    # probabilities are cumulative (pp50 <= pp30 <= ...), each bucket gets the difference
+    # to the previous available one
+    probs = np.stack([columns[key] for key in RAIN_PROPS], axis=1) if rowCount > 0 else np.empty((0, len(RAIN_PROPS)))
+    hasProb = ~np.isnan(probs)
+    lastIndex = np.maximum.accumulate(np.where(hasProb, np.arange(len(RAIN_PROPS)), -1), axis=1)
+    filled = np.where(lastIndex >= 0, np.take_along_axis(probs, np.maximum(lastIndex, 0), axis=1), 0)
+    previous = np.hstack([np.zeros((rowCount, 1)), filled[:, :-1]])
+    rows, cols = np.nonzero(hasProb)
+    rainfallProb: Optional[Dict[str, List[Any]]] = None
+    if len(rows) > 0:
+        rainfallProb = {
+            'dates': dateTimes[rows].tolist(),
+            'amount': RAIN_AMOUNTS[cols].tolist(),
+            'percentage': np.maximum(probs[rows, cols] - previous[rows, cols], 0).tolist(),
+        }
+
+    sunshineValues = columns['sunshine']
+    hasSunshine = ~np.isnan(sunshineValues)
+    if hourlySun:
+        sunDays, firstIndex, inverse = np.unique(days[hasSunshine], return_index=True, return_inverse=True)
+        order = np.argsort(firstIndex)
+        sums = np.bincount(inverse, weights=sunshineValues[hasSunshine] / 60.0, minlength=len(sunDays))
+        sunDates = sunDays[order]
+        sunAmounts = sums[order]
+    else:
+        sunDates = dateTimes[hasSunshine]
+        sunAmounts = sunshineValues[hasSunshine]
+    sunshine = {
+        'dates': sunDates.tolist(),
+        'sunshine': sunAmounts.tolist(),
+        'label': [f"{int(h)}h" for h in np.round(sunAmounts)],
+    }
+
+    return {
+        'temps': temps,
+        'extrema': extrema,
+        'rainfallProb': rainfallProb,
+        'rainFallAmount': rainFallAmount,
+        'sunshine': sunshine,
+    }
+
+
+def currentPlotHour() -> str:
+    """Versions the hourly plot window, the plots start at the current hour.
+
+    This is not Bright Sky's issue time, a forecast run published within the
+    hour is picked up when the cached plot expires."""
+    return datetime.utcnow().strftime('%Y-%m-%dT%H')
+
+
+def currentHour() -> np.datetime64:
+    return np.datetime64(datetime.utcnow().replace(minute=0, second=0, microsecond=0), 's')
+
+
+@dataclass
+class StationForecast:
+    columns: Dict[str, np.ndarray]
+    end: np.datetime64
+    lastRecord: Optional[str]
+    checked: float
+
+    def window(self, days: float) -> Dict[str, np.ndarray]:
+        start = currentHour()
+        end = start + np.timedelta64(int(days * 24 * 60), 'm')
+        utc = self.columns['utc']
+        mask = (utc >= start) & (utc < end)
+        return {name: values[mask] for name, values in self.columns.items()}
+
+    def current(self) -> Optional[Tuple[float, str]]:
+        """Temperature and condition of the forecast for the current hour."""
+        rows = np.nonzero(self.columns['utc'] == currentHour())[0]
+        if len(rows) == 0:
+            return None
+        row = rows[0]
+        return (float(self.columns['temperature'][row]), self.columns['condition'][row] or 'Unknown')
+
+
+class ForecastStore:
+    """Per-process store of the full forecast of each station in columnar form.
+
+    Both plot horizons and the current conditions are sliced from one /weather
+    response. After FORECAST_TTL only the station's sources are checked, and the
+    forecast is fetched again when Bright Sky published a newer run or the
+    fetched window runs out. A lock file per station lets concurrent render
+    workers share one upstream fetch through the HTTP cache.
+    """
+
+    entries: "OrderedDict[str, StationForecast]"
+
+    def __init__(self) -> None:
+        self.entries = OrderedDict()
+
+    def weatherUrl(self, stationId: str) -> str:
+        # aligned to the hour, so all workers request (and cache) the same url
+        start = currentHour()
+        end = start + np.timedelta64(FORECAST_DAYS * 24 + FORECAST_BUFFER_HOURS, 'h')
+        return f"{BRIGHTSKY_SERVER}/weather?wmo_station_id={stationId}&date={start}&last_date={end}"
+
+    @staticmethod
+    def forecastRecord(sources: List[Any]) -> Optional[str]:
+        return max((s['last_record'] for s in sources if s['observation_type'] == 'forecast'), default=None)
+
+    def lastRecord(self, session: CachedSession, stationId: str) -> Optional[str]:
+        sources = session.get(f"{BRIGHTSKY_SERVER}/sources?wmo_station_id={stationId}", expire_after=CURRENT_TTL).json()
+        return self.forecastRecord(sources['sources'])
+
+    def fetch(self, session: CachedSession, stationId: str, latest: Optional[str]) -> Optional[StationForecast]:
+        """Fetches the forecast, through the http cache unless the cached copy is older than `latest`."""
+        url = self.weatherUrl(stationId)
+        response = session.get(url, expire_after=FORECAST_TTL)
+        forecast = response.json()
+        cachedRecord = self.forecastRecord(forecast.get('sources', []))
+        if latest != None and getattr(response, 'from_cache', False) and (cachedRecord == None or cachedRecord < latest):
+            # the first worker to see the new run refetches it, the others find it in the cache
+            session.cache.delete_url(url)
+            forecast = session.get(url, expire_after=FORECAST_TTL).json()
+        if 'sources' not in forecast or 'weather' not in forecast:
+            logging.error(f"no sources or weather in forecast ({forecast})")
+            return None
+        lastRecord = self.forecastRecord(forecast['sources'])
+        end = currentHour() + np.timedelta64(FORECAST_DAYS * 24 + FORECAST_BUFFER_HOURS, 'h')
+        return StationForecast(toColumns(forecast['weather']), end, lastRecord, time.time())
+
+    def get(self, session: CachedSession, stationId: str) -> Optional[StationForecast]:
+        entry = self.entries.get(stationId)
+        if entry != None and time.time() - entry.checked < FORECAST_TTL:
+            self.entries.move_to_end(stationId)
+            return entry
+
+        os.makedirs(FORECAST_LOCK_DIR, exist_ok=True)
+        with open(os.path.join(FORECAST_LOCK_DIR, f"{stationId}.lock"), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            covered = entry != None and entry.end >= currentHour() + np.timedelta64(FORECAST_DAYS, 'D')
+            latest = self.lastRecord(session, stationId) if entry != None else None
+            if entry != None and covered and entry.lastRecord == latest:
+                logging.info(f"forecast for {stationId} unchanged")
+                entry.checked = time.time()
+            else:
+                entry = self.fetch(session, stationId, latest)
+                if entry == None:
+                    return None
+                self.entries[stationId] = entry
+
+        self.entries.move_to_end(stationId)
+        while len(self.entries) > FORECAST_STORE_SIZE:
+            self.entries.popitem(last=False)
+        return entry
+
+
 class WeatherProvider:
 
     requestsSession: CachedSession
+    renderStore: RenderStore
+    # shared by all instances of the process
+    forecastStore = ForecastStore()
 
     def __init__(self) -> None:
         self.requestsSession = getRequestsCache()
+        self.renderStore = RenderStore()
 
-    def plotForecast(self, forecast: Any, id: str, hourlySun: bool = True) -> io.BytesIO:
+    def plotForecast(self, columns: Dict[str, np.ndarray], id: str, hourlySun: bool = True) -> Tuple[io.BytesIO, str]:
         t1 = time.perf_counter()
-        rainfallProb = {
-            'dates': [],
-            'amount': [],
-            'percentage': [],
-        }
-        rainFallAmount = {
-            'dates': [],
-            'amount': []
-        }
-        temps = {
-            'dates': [],
-            'temps': []
-        }
-        sunshine = {
-            'dates': [],
-            'sunshine': [],
-            'label': []
-        }
-        rainProps = {
-            'pp50': 5,
-            'pp30': 3,
-            'pp20': 2,
-            'pp10': 1,
-            'pp05': 0.5,
-            'pp03': 0.3,
-            'pp02': 0.2,
-            'pp01': 0.1,
-            'pp00': 0,
-        }
-        for element in forecast['weather']:
-            dateWithTime = datetime.strptime(element['timestamp'], '%Y-%m-%dT%H:%M:%S%z')
-            datetimeStr = dateWithTime.strftime('%Y-%m-%dT%H:%M:%S%z')
-            date = dateWithTime.replace(hour=0, minute=0, second=0)
-            dateStr = date.strftime('%Y-%m-%dT%H:%M:%S%z')
-            if 'temperature' in element and element['temperature'] != None:
-                temps['dates'].append(datetimeStr)
-                temps['temps'].append(element['temperature'])
-
-            oldValue = 0
-            for key, value in rainProps.items():
-                if key in element and element[key] != None:
-                    rainfallProb['dates'].append(datetimeStr)
-                    rainfallProb['amount'].append(value)
-                    rainfallProb['percentage'].append(max(element[key] - oldValue, 0))
-                    oldValue = element[key]
-            if 'precipitation' in element and element['precipitation'] != None:
-                rainFallAmount['dates'].append(datetimeStr)
-                rainFallAmount['amount'].append(element['precipitation'])
-
-            if 'sunshine' in element and element['sunshine'] != None:
-                if hourlySun:
-                    try:
-                        i = sunshine['dates'].index(dateStr)
-                        sunshine['sunshine'][i] += element['sunshine'] / 60.0
-                    except ValueError:
-                        sunshine['dates'].append(dateStr)
-                        sunshine['sunshine'].append(element['sunshine'] / 60.0)
-                else:
-                    sunshine['dates'].append(datetimeStr)
-                    sunshine['sunshine'].append(element['sunshine'])
-        for i in range(len(sunshine['dates'])):
-            sunshine['label'].append(f"{int(np.round(sunshine['sunshine'][i]))}h")
-
-        if len(rainfallProb['dates']) == 0:
-            rainfallProb = None
-
-        data = {
-            'temps': temps,
-            'rainfallProb': rainfallProb,
-            'rainFallAmount': rainFallAmount,
-            'sunshine': sunshine,
-        }
-        rInFile = tempfile.NamedTemporaryFile(suffix='.json').name
-        rOutFile = tempfile.NamedTemporaryFile(suffix='.jpg').name
-        with open(rInFile, 'w') as outfile:
-            json.dump(data, outfile)
+        data = prepareForecast(columns, hourlySun)
+        key = RenderStore.key(data, hourlySun, PLOT_VERSION)
+        stored = self.renderStore.getPlot(key)
+        if stored != None:
+            logging.info(f"reusing stored plot {key} for {id}")
+            return (io.BytesIO(stored), key)
+
         t2 = time.perf_counter()
         printTime('data', t1, t2)
 
         t1 = time.perf_counter()
-        rPlotFun(rInFile, rOutFile, hourlySun)
+        plot = rServer.plot(data, hourlySun)
         t2 = time.perf_counter()
         printTime('plot', t1, t2)
 
-        with open(rOutFile, 'rb') as infile:
-            return io.BytesIO(infile.read())
+        self.renderStore.putPlot(key, plot)
+        return (io.BytesIO(plot), key)
 
 
-    def fetchAndPlot(self, lat: float, lon: float, duration: float) -> Optional[WeatherResult]:
-        if (duration > 10):
-            duration = 10
-        today = datetime.now().replace(minute=0, second=0, microsecond=0).isoformat()
-        lastday = (datetime.now() + timedelta(days=duration)).replace(minute=0, second=0, microsecond=0).isoformat()
-        forecast = {}
+    def fetchAndPlot(self, station: Station, duration: float) -> Optional[WeatherResult]:
+        if (duration > FORECAST_DAYS):
+            duration = FORECAST_DAYS
         try:
-            forecast = self.requestsSession.get(f"{BRIGHTSKY_SERVER}/weather?lat={lat}&lon={lon}&date={today}&last_date={lastday}", expire_after=30*60).json()
+            forecast = self.forecastStore.get(self.requestsSession, station['id'])
         except Exception as e:
-            logging.error(f"Couldn't fetch {lat}, {lon}, {e}")
+            logging.error(f"Couldn't fetch station {station['id']}, {e}")
             return None
-
-        if 'sources' not in forecast or 'weather' not in forecast:
-            logging.error(f"no sources or weather in forecast ({forecast})")
+        if forecast == None:
             return None
 
-        weather_station = forecast['sources'][0]['station_name']
-        weather_station_distance = forecast['sources'][0]['distance']
+        outbuffer, plotKey = self.plotForecast(forecast.window(duration), station['id'], duration > 2)
+        current = forecast.current()
+        return {
+            'plot': outbuffer,
+            'plotKey': plotKey,
+            'duration': duration,
+            'current_temp': current[0] if current != None else math.nan,
+            'current_str': current[1] if current != None else 'Unknown',
+            'weather_station': station['name'],
+            'weather_station_distance': station['distance'],
+        }
 
-        outbuffer = self.plotForecast(forecast, f"{lat}_{lon}", duration > 2)
+    def getStation(self, lat: float, lon: float) -> Optional[Station]:
         try:
-            current = self.requestsSession.get(f"{BRIGHTSKY_SERVER}/current_weather?lat={lat}&lon={lon}", expire_after=5*60).json()
-            return {
-                'plot': outbuffer,
-                'duration': duration,
-                'current_temp': current['weather']['temperature'],
-                'current_str': current['weather']['condition'],
-                'weather_station': weather_station.title(),
-                'weather_station_distance': int(weather_station_distance / 100) / 10,
-            }
-        except:
+            sources = self.requestsSession.get(f"{BRIGHTSKY_SERVER}/sources?lat={lat}&lon={lon}", expire_after=timedelta(days=7)).json()
+            source = next(filter(lambda s: s['observation_type'] == 'forecast' and s['wmo_station_id'] != None, sources['sources']))
             return {
-                'plot': outbuffer,
-                'duration': duration,
-                'current_temp': math.nan,
-                'current_str': 'Unknown',
-                'weather_station': weather_station.title(),
-                'weather_station_distance': int(weather_station_distance / 100) / 10,
+                'id': source['wmo_station_id'],
+                'name': source['station_name'].title(),
+                'distance': int(source['distance'] / 100) / 10,
             }
+        except Exception:
+            return None
 
     def getLocationInfo(self, lat: float, lon: float) -> Optional[Tuple[str, float]]:
-        try:
-            sources = self.requestsSession.get(f"{BRIGHTSKY_SERVER}/sources?lat={lat}&lon={lon}", expire_after=timedelta(days=7)).json()
-            source = sources['sources'][0]
-            return (source['station_name'].title(), int(source['distance'] / 100) / 10)
-        except Exception:
+        station = self.getStation(lat, lon)
+        if station == None:
             return None
+        return (station['name'], station['distance'])
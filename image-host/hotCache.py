@@ -0,0 +1,71 @@
+from collections import OrderedDict
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+# bytes of freshly uploaded files kept in memory per worker
+HOT_CACHE_BYTES = int(os.environ.get('HOT_CACHE_BYTES', str(64 * 1024 * 1024)))
+HOT_CACHE_MAX_ITEM = 8 * 1024 * 1024
+# telegram fetches an upload right after it is sent, older files are served from disk
+HOT_CACHE_TTL = 10 * 60
+
+
+class HotCache:
+    """Bounded LRU of recently uploaded files, served without touching the disk.
+
+    Entries expire after HOT_CACHE_TTL, long before the retention of the files
+    on disk. A file evicted for the IMAGE_DISK_QUOTA may still be served from
+    here for up to HOT_CACHE_TTL, HEAD requests always check the disk.
+    """
+
+    entries: "OrderedDict[str, Tuple[bytes, float]]"
+
+    def __init__(self, maxBytes: int = HOT_CACHE_BYTES, ttl: float = HOT_CACHE_TTL) -> None:
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, name: str, content: bytes):
+        if len(content) > HOT_CACHE_MAX_ITEM or self.maxBytes <= 0:
+            return
+        self.pop(name)
+        self.entries[name] = (content, time.monotonic())
+        self.size += len(content)
+        while self.size > self.maxBytes:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def putFile(self, path: str):
+        if os.path.getsize(path) <= HOT_CACHE_MAX_ITEM:
+            with open(path, 'rb') as f:
+                self.put(os.path.basename(path), f.read())
+
+    def pop(self, name: str):
+        entry = self.entries.pop(name, None)
+        if entry != None:
+            self.size -= len(entry[0])
+
+    def get(self, name: str) -> Optional[bytes]:
+        entry = self.entries.get(name)
+        if entry != None and time.monotonic() - entry[1] > self.ttl:
+            self.pop(name)
+            entry = None
+        if entry == None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(name)
+        self.hits += 1
+        return entry[0]
+
+    def info(self) -> Dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / requests if requests > 0 else 0,
+        }
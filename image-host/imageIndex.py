@@ -0,0 +1,143 @@
+from contextlib import contextmanager
+import fcntl
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Iterator, List, Optional, TextIO, Tuple
+
+DATA_DIR = '/data'
+INDEX_PATH = os.environ.get('IMAGE_INDEX_PATH', '/data/.index.sqlite')
+CLEANER_LOCK_PATH = os.environ.get('IMAGE_CLEANER_LOCK', '/data/.cleaner.lock')
+MAX_AGE = 2 * 24 * 60 * 60
+# bytes of /data the stored files may use, 0 disables the quota
+DISK_QUOTA = int(os.environ.get('IMAGE_DISK_QUOTA', '0'))
+# last access updates closer together than this are skipped
+ACCESS_RESOLUTION = 60
+# files whose last access this worker recorded, older ones are dropped when it is full
+ACCESS_MEMORY = 10000
+EVICT_BATCH = 100
+
+SCHEMA = '''
+create table if not exists files (name text primary key, size integer not null, stored real not null, accessed real not null);
+create index if not exists files_stored on files (stored);
+create index if not exists files_accessed on files (accessed);
+create table if not exists total (id integer primary key check (id = 0), size integer not null);
+insert or ignore into total values (0, 0);
+create trigger if not exists files_insert after insert on files begin
+    update total set size = size + new.size;
+end;
+create trigger if not exists files_delete after delete on files begin
+    update total set size = size - old.size;
+end;
+create trigger if not exists files_update after update of size on files begin
+    update total set size = size - old.size + new.size;
+end;
+'''
+
+
+@contextmanager
+def connect() -> Iterator[sqlite3.Connection]:
+    # one short connection per operation, the gevent workers run requests in separate greenlets
+    con = sqlite3.connect(INDEX_PATH, timeout=10)
+    try:
+        with con:
+            yield con
+    finally:
+        con.close()
+
+
+def setup():
+    """Creates the index, files stored before it existed are indexed once."""
+    with connect() as con:
+        con.execute('pragma journal_mode=wal')
+        con.executescript(SCHEMA)
+        if con.execute('select count(*) from files').fetchone()[0] > 0:
+            return
+        entries = []
+        for entry in os.scandir(DATA_DIR):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_size, stat.st_mtime, stat.st_mtime))
+        con.executemany('insert or ignore into files values (?, ?, ?, ?)', entries)
+        logging.warning(f"indexed {len(entries)} existing files")
+
+
+recentAccess: Dict[str, float] = {}
+
+
+def record(name: str):
+    """Adds a stored file to the index or, for a repeated upload, restarts its retention."""
+    size = os.path.getsize(os.path.join(DATA_DIR, name))
+    now = time.time()
+    with connect() as con:
+        con.execute('insert into files values (?, ?, ?, ?) on conflict (name) do update set size = excluded.size, '
+                    'stored = excluded.stored, accessed = excluded.accessed', (name, size, now, now))
+    recentAccess[name] = now
+
+
+def access(name: str):
+    """Records a read, at most once per ACCESS_RESOLUTION and worker, most reads never touch sqlite."""
+    now = time.time()
+    if now - recentAccess.get(name, 0) < ACCESS_RESOLUTION:
+        return
+    if len(recentAccess) >= ACCESS_MEMORY:
+        for key in [key for key, accessed in recentAccess.items() if now - accessed >= ACCESS_RESOLUTION]:
+            del recentAccess[key]
+        if len(recentAccess) >= ACCESS_MEMORY:
+            recentAccess.clear()
+    recentAccess[name] = now
+    with connect() as con:
+        con.execute('update files set accessed = ? where name = ? and accessed < ?', (now, name, now - ACCESS_RESOLUTION))
+
+
+def remove(con: sqlite3.Connection, rows: List[Tuple[str]]):
+    for (name,) in rows:
+        try:
+            os.remove(os.path.join(DATA_DIR, name))
+        except FileNotFoundError:
+            pass
+    con.executemany('delete from files where name = ?', rows)
+
+
+def expire() -> int:
+    """Deletes the files older than MAX_AGE, only the expired rows are read."""
+    with connect() as con:
+        rows = con.execute('select name from files where stored < ?', (time.time() - MAX_AGE,)).fetchall()
+        remove(con, rows)
+    return len(rows)
+
+
+def evict(quota: int = DISK_QUOTA) -> int:
+    """Deletes the least recently accessed files until the store fits the quota."""
+    if quota <= 0:
+        return 0
+    evicted = 0
+    with connect() as con:
+        total = con.execute('select size from total').fetchone()[0]
+        while total > quota:
+            rows = con.execute('select name, size from files order by accessed limit ?', (EVICT_BATCH,)).fetchall()
+            if len(rows) == 0:
+                break
+            victims = []
+            for name, size in rows:
+                if total <= quota:
+                    break
+                victims.append((name,))
+                total -= size
+            remove(con, victims)
+            evicted += len(victims)
+    return evicted
+
+
+def electCleaner() -> Optional[TextIO]:
+    """Takes the cleaner lock of the host, returns None if another worker holds it.
+
+    The lock is released when the holding worker exits, so another one takes over."""
+    lockFile = open(CLEANER_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return lockFile
+    except BlockingIOError:
+        lockFile.close()
+        return None
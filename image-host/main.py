@@ -1,8 +1,8 @@
-from datetime import datetime, timedelta
 import logging
 import os
-from pathlib import Path
-from typing import Any
+import time
+from typing import Any, Dict, Set, Tuple
+import uuid
 from flask import Flask, request, jsonify
 from flask.helpers import make_response, send_from_directory
 from flask.wrappers import Response
@@ -10,6 +10,10 @@ import hashlib
 from PIL import Image
 import socket
 import gevent
+import imageIndex
+from hotCache import HotCache
+import mimetypes
+from imageIndex import DATA_DIR
 
 app = Flask(__name__)
 
@@ -27,31 +31,176 @@ def e405(_):
 def e500(_):
     return make_response(jsonify({'status': 500}), 500)
 
+CHUNK_SIZE = 65536
+THUMB_SIZE = (200, 200)
+CLEAN_INTERVAL = 10 * 60
+# names are content hashes, a file never changes
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+# uploads are only accepted from these hosts
+ALLOWED_HOSTS = ['weatherbot']
+ALLOWLIST_TTL = 5 * 60
+ALLOWLIST_RETRY = 10
+
+hotCache = HotCache()
+
+
+def receive(file: Any) -> Tuple[str, str]:
+    """Streams an upload to a temporary file while hashing it.
+
+    Returns the short content hash and the path of the temporary file."""
+    hash = hashlib.sha256()
+    tmpPath = os.path.join(DATA_DIR, f".{uuid.uuid4().hex}.tmp")
+    with open(tmpPath, 'wb') as out:
+        chunk = file.read(CHUNK_SIZE)
+        while len(chunk) > 0:
+            hash.update(chunk)
+            out.write(chunk)
+            chunk = file.read(CHUNK_SIZE)
+    return (hash.hexdigest()[:10], tmpPath)
+
+
+def exists(name: str) -> bool:
+    """Whether the content is already stored, a hit restarts its retention."""
+    if not os.path.exists(f"{DATA_DIR}/{name}"):
+        return False
+    imageIndex.record(name)
+    return True
+
+
+def createThumbnail(imagePath: str, thumbPath: str):
+    with Image.open(imagePath) as image:
+        thumb = image.convert('RGB')
+        thumb.thumbnail(THUMB_SIZE)
+        tmpPath = f"{thumbPath}.{uuid.uuid4().hex}.tmp"
+        thumb.save(tmpPath, 'JPEG')
+        os.replace(tmpPath, thumbPath)
+    imageIndex.record(os.path.basename(thumbPath))
+    hotCache.putFile(thumbPath)
+
+
+def resolveAllowlist() -> Set[str]:
+    addresses: Set[str] = set()
+    for host in ALLOWED_HOSTS:
+        try:
+            addresses.update(socket.gethostbyname_ex(host)[2])
+        except socket.gaierror as e:
+            logging.error(f"could not resolve {host}: {e}")
+    return addresses
+
+
+allowlist: Set[str] = set()
+allowlistResolved = 0.0
+
+
+def allowed(address: str) -> bool:
+    """Whether the address belongs to the bot, resolved at most every ALLOWLIST_TTL.
+
+    An unknown address resolves again after ALLOWLIST_RETRY, in case the bot restarted with a new one."""
+    global allowlist, allowlistResolved
+    age = time.monotonic() - allowlistResolved
+    if age > ALLOWLIST_TTL or (address not in allowlist and age > ALLOWLIST_RETRY):
+        allowlist = resolveAllowlist()
+        allowlistResolved = time.monotonic()
+    return address in allowlist
+
+
+class UploadError(Exception):
+    pass
+
+
+def storeAnimation(file: Any, poster: Any = None) -> Dict[str, Any]:
+    hash, tmpPath = receive(file)
+    name = f"{hash}.mp4"
+    if exists(name):
+        os.remove(tmpPath)
+    else:
+        os.replace(tmpPath, f"{DATA_DIR}/{name}")
+        imageIndex.record(name)
+        hotCache.putFile(f"{DATA_DIR}/{name}")
+    link = f"{os.environ.get('IMAGES_URL')}/animation/{name}"
+    # without a poster frame clients fall back to the animation itself
+    thumb = link
+    thumbName = f"{hash}_t.jpg"
+    if exists(thumbName):
+        thumb = f"{os.environ.get('IMAGES_URL')}/animation/{thumbName}"
+    elif poster:
+        posterPath = f"{DATA_DIR}/{thumbName}"
+        posterTmp = f"{posterPath}.{uuid.uuid4().hex}.tmp"
+        try:
+            jpg = Image.open(poster).convert('RGB')
+            jpg.thumbnail(THUMB_SIZE)
+            jpg.save(posterTmp, 'JPEG')
+            os.replace(posterTmp, posterPath)
+            imageIndex.record(thumbName)
+            hotCache.putFile(posterPath)
+            thumb = f"{os.environ.get('IMAGES_URL')}/animation/{thumbName}"
+        except IOError as e:
+            logging.error(e, exc_info=True)
+            if os.path.exists(posterTmp):
+                os.remove(posterTmp)
+    return {
+        'id': hash,
+        'link': link,
+        'thumb': thumb,
+    }
+
+
+def storeImage(file: Any) -> Dict[str, Any]:
+    hash, tmpPath = receive(file)
+    imageName = f"{hash}.jpg"
+    thumbName = f"{hash}_t.jpg"
+    imagePath = f"{DATA_DIR}/{imageName}"
+    try:
+        if exists(imageName):
+            os.remove(tmpPath)
+        else:
+            with Image.open(tmpPath) as image:
+                if image.format == 'JPEG':
+                    image.verify()
+                    jpg = None
+                else:
+                    jpg = image.convert('RGB')
+            if jpg == None:
+                os.replace(tmpPath, imagePath)
+            else:
+                jpg.save(imagePath, 'JPEG')
+                os.remove(tmpPath)
+            imageIndex.record(imageName)
+            hotCache.putFile(imagePath)
+        # only reads the header, the thumbnail is created on its first request
+        with Image.open(imagePath) as image:
+            width, height = image.size
+    except (IOError, SyntaxError) as e:
+        logging.error(e, exc_info=True)
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise UploadError('Cannot parse as image')
+    return {
+        'id': hash,
+        'link': f"{os.environ.get('IMAGES_URL')}/image/{imageName}",
+        'thumb': f"{os.environ.get('IMAGES_URL')}/image/{thumbName}",
+        'width': width,
+        'height': height
+    }
+
+
+def created(result: Dict[str, Any]) -> Response:
+    response = jsonify(result)
+    response.status_code = 201
+    response.autocorrect_location_header = False
+    return response
+
+
 @app.route('/animation', methods=['POST'])
 def postAnimation() -> Response:
-    if socket.gethostbyname('weatherbot') != request.remote_addr:
+    if not allowed(request.remote_addr):
         return e405(0)
 
     if 'animation' not in request.files:
         return make_response(jsonify({'error': 'No animation'}), 400)
     file = request.files['animation']
     if file:
-        hash = hashlib.sha256()
-        fb = file.read(65536)
-        while len(fb) > 0:
-            hash.update(fb)
-            fb = file.read(65536)
-        file.seek(0)
-        hash = hash.hexdigest()[:10]
-        name = f"{hash}.mp4"
-        file.save(f'/data/{name}')
-        response = jsonify({
-            'id': hash,
-            'link': f"{os.environ.get('IMAGES_URL')}/animation/{name}",
-        })
-        response.status_code = 201
-        response.autocorrect_location_header = False
-        return response
+        return created(storeAnimation(file, request.files.get('poster')))
     else:
         return make_response(jsonify({'error': 'No valid mp4 animation'}), 400)
 
@@ -59,7 +208,7 @@ def postAnimation() -> Response:
 
 @app.route('/image', methods=['POST'])
 def postImage() -> Response:
-    if socket.gethostbyname('weatherbot') != request.remote_addr:
+    if not allowed(request.remote_addr):
         return e405(0)
 
     if 'image' not in request.files:
@@ -67,62 +216,85 @@ def postImage() -> Response:
     file = request.files['image']
     if file:
         try:
-            hash = hashlib.sha256()
-            fb = file.read(65536)
-            while len(fb) > 0:
-                hash.update(fb)
-                fb = file.read(65536)
-            hash = hash.hexdigest()[:10]
-
-            imageName = f"{hash}.jpg"
-            thumbName = f"{hash}_t.jpg"
-            jpg = Image.open(file).convert('RGB')
-            width = jpg.width
-            height = jpg.height
-            jpg.save(f"/data/{imageName}")
-            jpg.thumbnail((200, 200))
-            jpg.save(f"/data/{thumbName}")
-
-            response = jsonify({
-                'id': hash,
-                'link': f"{os.environ.get('IMAGES_URL')}/image/{imageName}",
-                'thumb': f"{os.environ.get('IMAGES_URL')}/image/{thumbName}",
-                'width': width,
-                'height': height
-            })
-            response.status_code = 201
-            response.autocorrect_location_header = False
-            return response
-        except IOError as e:
-            logging.error(e, exc_info=True)
-            return make_response(jsonify({'error': "Cannot parse as image", 'status': 400}), 400)
+            return created(storeImage(file))
+        except UploadError as e:
+            return make_response(jsonify({'error': str(e), 'status': 400}), 400)
     return make_response(jsonify({'error': "No image found", 'status': 400}), 400)
 
 
+@app.route('/batch', methods=['POST'])
+def postBatch() -> Response:
+    """Stores several artifacts from one multipart request.
+
+    Parts are named 'image:<key>' or 'animation:<key>', 'poster:<key>' is the
+    poster frame of the animation with the same key. The response maps every
+    key to its upload result or an error."""
+    if not allowed(request.remote_addr):
+        return e405(0)
+
+    results: Dict[str, Any] = {}
+    for field, file in request.files.items():
+        kind, _, key = field.partition(':')
+        if not file or key == '' or kind not in ('image', 'animation'):
+            continue
+        try:
+            if kind == 'image':
+                results[key] = storeImage(file)
+            else:
+                results[key] = storeAnimation(file, request.files.get(f"poster:{key}"))
+        except UploadError as e:
+            results[key] = {'error': str(e)}
+    if len(results) == 0:
+        return make_response(jsonify({'error': 'No artifacts', 'status': 400}), 400)
+    return created({'results': results})
+
+
 @app.route('/image/<file>', methods=['GET'])
 @app.route('/animation/<file>', methods=['GET'])
 def get(file: str) -> Response:
-    return send_from_directory('/data', file)
+    # the bot checks with HEAD if an upload still exists, that is answered from the disk
+    content = hotCache.get(file) if request.method != 'HEAD' else None
+    if content != None:
+        response = Response(content, mimetype=mimetypes.guess_type(file)[0])
+        response.set_etag(file)
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_MAX_AGE
+        response.cache_control.immutable = True
+        response.accept_ranges = 'bytes'
+        # answers If-None-Match with 304 and Range with 206
+        response = response.make_conditional(request, accept_ranges=True, complete_length=len(content))
+    else:
+        if file.endswith('_t.jpg') and not os.path.exists(os.path.join(DATA_DIR, file)):
+            imagePath = os.path.join(DATA_DIR, file[:-len('_t.jpg')] + '.jpg')
+            if os.path.exists(imagePath):
+                createThumbnail(imagePath, os.path.join(DATA_DIR, file))
+        response = send_from_directory(DATA_DIR, file, etag=file, max_age=CACHE_MAX_AGE)
+        response.cache_control.immutable = True
+    imageIndex.access(file)
+    return response
 
 
-def deleteOldImages():
+def clean():
+    # every gunicorn worker runs this, the one holding the cleaner lock does the work
+    cleaner = None
     while True:
-        logging.warning("deleting old images")
-
-        for item in Path('/data/').glob('*'):
+        if cleaner == None:
+            cleaner = imageIndex.electCleaner()
+        if cleaner != None:
             try:
-                if item.is_file():
-                    itemTime = datetime.fromtimestamp(item.stat().st_mtime)
-                    if itemTime < datetime.now() - timedelta(days=2):
-                        os.remove(item)
-                        logging.warning(f"deleted {item}")
-            except:
-                pass
-        gevent.sleep(60 * 60)
+                expired = imageIndex.expire()
+                evicted = imageIndex.evict()
+                if expired > 0 or evicted > 0:
+                    logging.warning(f"deleted {expired} expired and {evicted} evicted files")
+            except Exception as e:
+                logging.error(e, exc_info=True)
+        logging.warning(f"hot cache of worker {os.getpid()}: {hotCache.info()}")
+        gevent.sleep(CLEAN_INTERVAL)
 
 @app.before_first_request
 def startClear():
-    gevent.spawn(deleteOldImages)
+    imageIndex.setup()
+    gevent.spawn(clean)
 
 if __name__ == '__main__':
     app.run(debug=True, port=80, host='0.0.0.0')